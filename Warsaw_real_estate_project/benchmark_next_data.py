@@ -0,0 +1,84 @@
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from bs4 import BeautifulSoup
+from next_data import extract_next_data, parse_ad
+
+#usage: python benchmark_next_data.py [saved_offer_page.html ...]
+#without arguments a synthetic page of a similar size as an otodom offer page is used
+
+repeats = 50
+
+
+def synthetic_page():
+    '''Offer page with the same structure as otodom: a lot of markup and a big __NEXT_DATA__ with the ad first'''
+    ad = {
+        'target': {'Extras_types': ['balcony', 'lift', 'basement']},
+        'additionalInformation': [{'label': 'build_year', 'values': ['2006']}],
+        'characteristics': [{'key': k, 'value': v} for k, v in [('price', '822000'), ('m', '46.41'), ('rooms_num', '2'), ('floor_no', 'floor_3')]],
+        'location': {'coordinates': {'latitude': 52.2566872, 'longitude': 20.9328927}},
+        'description': 'Mieszkanie ' * 400
+    }
+    next_data = {
+        'props': {'pageProps': {
+            'ad': ad,
+            'relatedAds': [dict(ad, description='') for _ in range(30)],
+            'translations': {f'key_{i}': f'translation text number {i}' for i in range(3000)}
+        }},
+        'page': '/pl/oferta/[slug]'
+    }
+    markup = '<div class="css-1x2y3z"><span data-cy="label">Cena</span><a href="/pl/oferta/x">link</a></div>' * 3000
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Oferta</title></head><body>'
+        + markup
+        + '<script id="__NEXT_DATA__" type="application/json">' + json.dumps(next_data, separators=(',', ':')) + '</script>'
+        + '</body></html>'
+    ).encode('utf-8')
+
+
+def soup_path(page):
+    #path used by the scraper before, full DOM and full json
+    soup = BeautifulSoup(page, 'html.parser')
+    script_tag = soup.find('script', id='__NEXT_DATA__')
+    return json.loads(script_tag.string)['props']['pageProps']['ad']
+
+
+def slice_path(page):
+    return parse_ad(extract_next_data(page))
+
+
+def measure(func, pages):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for page in pages:
+            func(page)
+    per_page = (time.perf_counter() - start) / (repeats * len(pages))
+
+    tracemalloc.start()
+    for page in pages:
+        func(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return per_page, peak
+
+
+def main():
+    pages = [Path(p).read_bytes() for p in sys.argv[1:]] or [synthetic_page()]
+
+    #both paths have to return the same ad before comparing speed
+    for page in pages:
+        assert soup_path(page) == slice_path(page)
+
+    print(f'{len(pages)} page(s), average size {sum(map(len, pages)) / len(pages) / 1024:.0f} KB, {repeats} repeats')
+    results = {name: measure(func, pages) for name, func in [('BeautifulSoup', soup_path), ('byte slice', slice_path)]}
+    for name, (per_page, peak) in results.items():
+        print(f'{name:>14}: {per_page * 1000:8.2f} ms/page, peak memory {peak / 1024 / 1024:6.1f} MB')
+
+    speedup = results['BeautifulSoup'][0] / results['byte slice'][0]
+    print(f'Speedup: {speedup:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
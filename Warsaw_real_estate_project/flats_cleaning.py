@@ -0,0 +1,342 @@
+import glob
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+import numpy as np
+import polars as pl
+import polars.selectors as cs
+from polars import col
+from scrape_sinks import row_schema
+
+#cleaning rules from Cleaning.ipynb (the notebook keeps the EDA and the reasoning behind every bound) as one lazy plan
+
+#extras packed into one extras_mask column, the position in the list is the bit of the feature (lift = 1, balcony = 2, garage = 4, ...)
+extra_features = [
+    'lift',
+    'balcony',
+    'garage',
+    'basement',
+    'separate_kitchen',
+    'usable_room',
+    'air_conditioning',
+    'terrace',
+    'garden',
+    'two_storey'
+]
+
+extra_bits = {f: 1 << i for i, f in enumerate(extra_features)}
+
+cat_columns = ['building_type', 'windows_type', 'construction_status', 'building_ownership']
+
+#output of the streaming mode, one directory per month and district (month=2026-01/district=Bemowo/...)
+dataset_dir = 'flats_dataset'
+
+#key mixed into every hash, changing it changes all ids
+id_key = b'warsaw_flats'
+
+#64-bit FNV-1a constants
+fnv_offset = 14695981039346656037
+fnv_prime = 1099511628211
+
+#columns describing the current state of an offer, a change in any of them changes content_hash
+content_columns = [
+    'price', 'rent', 'area', 'price_per_sq_m', 'no_rooms', 'building_type', 'no_floor',
+    'building_floors_num', 'windows_type', 'construction_status', 'building_ownership',
+    'lat', 'long', 'district', 'built_year', *extra_features, 'is_primary'
+]
+
+
+def extras_mask():
+    '''extras text parsed once into a bitmask of extra_bits, tokens outside the list are ignored'''
+    return (
+        col('extras')
+        .str.split(',')
+        .list.eval(pl.element().str.strip_chars().replace_strict(extra_bits, default=0, return_dtype=pl.Int16))
+        #a feature listed twice ('lift, lift') counts once, a sum of repeated bits would set another feature's bit
+        .list.unique()
+        .list.sum()
+        .cast(pl.Int16)
+        .alias('extras_mask')
+    )
+
+
+def has_extras(features):
+    '''One bitwise test for "has all of the features"'''
+    bits = sum(extra_bits[f] for f in features)
+    return (col('extras_mask') & bits) == bits
+
+
+def extras_flags(features=extra_features):
+    '''0/1 column of every feature derived from extras_mask'''
+    return [((col('extras_mask') & extra_bits[f]) != 0).cast(pl.Int8).alias(f) for f in features]
+
+
+def extras_names(features=extra_features):
+    '''Features of extras_mask as text, comma separated like the extras column of the scraped rows'''
+    return (
+        pl.concat_list([pl.when((col('extras_mask') & extra_bits[f]) != 0).then(pl.lit(f)) for f in features])
+        .list.drop_nulls()
+        .list.join(', ')
+        .alias('extras')
+    )
+
+
+def scan_raw(month):
+    '''Lazy frame of a scraped month, saved either as parquet parts or as the csv file'''
+    if os.path.isdir(f'otodom_scraped_{month}'):
+        return scan_raw_path(f'otodom_scraped_{month}')
+    return scan_raw_path(f'otodom_scraped_{month}.csv')
+
+
+def scan_raw_path(path):
+    if os.path.isdir(path):
+        return pl.scan_parquet(os.path.join(path, 'part-*.parquet')).select(list(row_schema)).cast(row_schema)
+    return pl.scan_csv(path, separator=';', quote_char='"', schema=row_schema)
+
+
+def month_of(path):
+    #month is taken from the file name, e.g. otodom_scraped_2026-01.csv
+    match = re.search(r'(\d{4}-\d{2})', os.path.basename(os.path.normpath(path)))
+    if not match:
+        raise ValueError(f'No month in the name of {path}')
+    return match.group(1)
+
+
+def stable_hash(series):
+    '''64-bit FNV-1a of id_key + text, computed with numpy over the arrow buffers of the whole column,
+    so the same text gets the same hash in every session and polars version (unlike Expr.hash)'''
+    arr = series.cast(pl.String).fill_null('').to_arrow()
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64)[arr.offset:arr.offset + len(arr) + 1]
+    data = np.frombuffer(arr.buffers()[2], dtype=np.uint8) if arr.buffers()[2] is not None else np.zeros(1, dtype=np.uint8)
+
+    #hashing the key once, every row continues from this state
+    start = fnv_offset
+    for byte in id_key:
+        start = ((start ^ byte) * fnv_prime) % 2 ** 64
+
+    hashes = np.full(len(arr), start, dtype=np.uint64)
+    prime = np.uint64(fnv_prime)
+    lengths = np.diff(offsets)
+    #one step per byte position for all rows at once, rows shorter than the position keep their hash
+    for i in range(int(lengths.max()) if len(lengths) else 0):
+        active = lengths > i
+        byte = data[np.minimum(offsets[:-1] + i, len(data) - 1)].astype(np.uint64)
+        hashes = np.where(active, (hashes ^ byte) * prime, hashes)
+
+    return pl.Series(series.name, hashes.view(np.int64))
+
+
+#otodom id at the end of the url (e.g. ...-ID4y2o4), the same in the /pl/oferta/ and /hpr/pl/oferta/ urls of an offer
+offer_id_pattern = r'-(ID[0-9A-Za-z]+)$'
+
+
+def offer_key():
+    #otodom id of the url column, the whole url if it's missing
+    return pl.coalesce(col('url').str.extract(offer_id_pattern), col('url'))
+
+
+def url_key(url):
+    '''offer_key of a single url'''
+    match = re.search(offer_id_pattern, url)
+    return match.group(1) if match else url
+
+
+def offer_id():
+    '''id of the offer computed from the url column'''
+    return offer_key().map_batches(stable_hash, return_dtype=pl.Int64, is_elementwise=True).alias('id')
+
+
+def content_key():
+    #floats are stored as scaled integers, so the text doesn't depend on how a polars version formats floats
+    parts = []
+    for c in content_columns:
+        if c in extra_bits:
+            #flags taken out of the mask, so the fingerprint is the same as when they were separate columns
+            parts.append(((col('extras_mask') & extra_bits[c]) != 0).cast(pl.Int8).cast(pl.String))
+        elif c in ('price', 'rent', 'area', 'price_per_sq_m', 'lat', 'long'):
+            parts.append((col(c) * 1_000_000).round().cast(pl.Int64).cast(pl.String).fill_null(''))
+        else:
+            parts.append(col(c).cast(pl.String).fill_null(''))
+    return pl.concat_str(parts, separator='|')
+
+
+def with_ids(flats):
+    '''id from the otodom offer id (same offer, same id in every month) and content_hash of the offer's current state'''
+    return flats.with_columns(
+        offer_id(),
+        content_key().map_batches(stable_hash, return_dtype=pl.Int64, is_elementwise=True).alias('content_hash')
+    )
+
+
+def clean(flats, month, maintain_order=True):
+    '''Building the cleaning plan on a lazy frame of raw scraped rows'''
+    max_year = datetime.now().year + 2
+
+    flats = (
+        flats
+        #the same offer can be scraped twice (e.g. on two result pages), copies are identical so any of them can be kept
+        .unique(keep='first' if maintain_order else 'any', maintain_order=maintain_order)
+        .filter(col('price').is_not_null())
+
+        #rent below 6 PLN/m² or above 50 PLN/m² is treated as a mistake in the offer
+        .with_columns((col('rent') / col('area')).round(2).alias('rent_per_sq_m'))
+        .with_columns(
+            pl.when(col('rent_per_sq_m').is_between(6, 50, closed='both'))
+            .then('rent')
+            .otherwise(None)
+            .ceil()
+            .alias('rent')
+        )
+
+        #bottom of the market is around 10.5k PLN/m², upper bound leaves the luxury apartments in
+        .filter(col('price_per_sq_m').is_between(10500, 100000, closed='both'))
+
+        #from the oldest residential buildings in warsaw till planned investments
+        .filter(col('built_year').is_between(1890, max_year) | col('built_year').is_null())
+
+        .with_columns(
+            pl.when(col('no_rooms').str.contains(r'\d'))
+            .then(col('no_rooms').str.extract(r'(\d+)').cast(pl.Int64))
+            .otherwise(None)
+            .alias('no_rooms')
+        )
+
+        #tallest residential building in warsaw has 52~54 floors
+        .filter(col('building_floors_num').is_between(0, 54, closed='both'))
+
+        .with_columns(
+            pl.when(col('no_floor').str.contains(r'\d'))
+            .then(col('no_floor').str.extract(r'(\d+)').cast(pl.Int64))
+            .when(col('no_floor') == 'ground_floor')
+            .then(0)
+            .when(col('no_floor') == 'cellar')
+            .then(-1)
+            .when(col('no_floor') == 'garret')
+            .then(col('building_floors_num'))
+            .otherwise(None)
+            .alias('no_floor')
+        )
+
+        .filter(col('area').is_between(15, 350, closed='both'))
+
+        #filling nulls in text columns with 'unknown'
+        .with_columns(
+            cs.string()
+            .str.strip_chars()
+            .replace('', 'unknown')
+            .fill_null('unknown')
+        )
+        .with_columns(
+            col(c)
+            .str.replace_all('_', ' ')
+            .str.to_titlecase()
+            .cast(pl.Categorical)
+            for c in cat_columns
+        )
+        .with_columns(
+            col('district')
+            .str.replace_all('--', '-')
+            .str.to_titlecase()
+            .cast(pl.Categorical)
+        )
+        .with_columns((col('rent') / col('area')).alias('rent_per_sq_m'))
+
+        #all extras in one column, the 0/1 flags can be taken out of it with extras_flags()
+        .with_columns(extras_mask())
+        .drop('extras')
+
+        #when/then instead of replace_strict, which the streaming engine can't run
+        .with_columns(
+            pl.when(col('market_type') == 'primary')
+            .then(1)
+            .when(col('market_type') == 'secondary')
+            .then(0)
+            .otherwise(None)
+            .cast(pl.Int8)
+            .alias('is_primary')
+        )
+        .drop('market_type')
+    )
+
+    #stable identifiers for later loading of data into sql db
+    flats = with_ids(flats)
+    #an offer listed in a few districts is kept once, always the copy with the smallest content_hash
+    #and of those the one with the smallest url (copies with the same content can differ only in the url, e.g. /hpr/pl/oferta/),
+    #so both modes give the same row (joins instead of a window or a min of the urls, which the streaming engine can't run)
+    kept = flats.group_by('id').agg(col('content_hash').min())
+    flats = flats.join(kept, on=['id', 'content_hash'], how='inner')
+    larger_urls = (
+        flats.select('id', 'url')
+        .join(flats.select('id', col('url').alias('smaller_url')), on='id')
+        .filter(col('smaller_url') < col('url'))
+        .select('id', 'url', pl.lit(True).alias('has_smaller_url'))
+        .unique(subset=['id', 'url'], keep='any')
+    )
+    flats = (
+        flats
+        .join(larger_urls, on=['id', 'url'], how='left')
+        .filter(col('has_smaller_url').is_null())
+        .drop('has_smaller_url')
+        .unique(subset='id', keep='first' if maintain_order else 'any', maintain_order=maintain_order)
+        .select(['id', 'content_hash', pl.exclude('id', 'content_hash')])
+        .with_columns(pl.lit(month + '-01').cast(pl.Date).alias('date_scraped'))
+    )
+    return flats
+
+
+def write_partitions(flats, month, output_dir=dataset_dir):
+    '''Writing a cleaned month (lazy frame) into the dataset, one parquet file per district with min/max statistics'''
+    os.makedirs(output_dir, exist_ok=True)
+    month_dir = os.path.join(output_dir, f'month={month}')
+    tmp_path = os.path.join(output_dir, f'month={month}.tmp.parquet')
+
+    #streaming engine processes the month in batches and writes them straight to disk,
+    #parquet dictionary-encodes text anyway, so categories are stored as plain strings
+    flats.with_columns(cs.categorical().cast(pl.String)).sink_parquet(tmp_path, statistics=True)
+
+    #a month that is cleaned again replaces its old partitions
+    shutil.rmtree(month_dir, ignore_errors=True)
+    districts = pl.scan_parquet(tmp_path).select(col('district').unique()).collect()['district']
+    for district in districts:
+        district_dir = os.path.join(month_dir, f'district={district}')
+        os.makedirs(district_dir, exist_ok=True)
+        #partition values are kept in the directory names, not in the files
+        (
+            pl.scan_parquet(tmp_path)
+            .filter(col('district') == district)
+            .drop('district')
+            .sink_parquet(os.path.join(district_dir, 'part-0.parquet'), statistics=True)
+        )
+    os.remove(tmp_path)
+    return month_dir, len(districts)
+
+
+def clean_month(month):
+    '''Cleaning otodom_scraped_{month} into flats_{month}.csv with a single collect, the month is also written to the dataset'''
+    flats = clean(scan_raw(month), month).collect()
+    flats.write_csv(f'flats_{month}.csv', separator=';', quote_char='"', quote_style='non_numeric')
+    print(f'Saved {len(flats)} cleaned offers to flats_{month}.csv')
+    month_dir, n_districts = write_partitions(flats.lazy(), month)
+    print(f'Saved the month to {month_dir} ({n_districts} districts)')
+    return flats
+
+
+def clean_streaming(paths, output_dir=dataset_dir):
+    '''Cleaning any number of scraped files in bounded memory, output partitioned by month and district'''
+    #files are cleaned one by one, so memory stays flat however many months and cities there are
+    for path in paths:
+        month = month_of(path)
+        month_dir, n_districts = write_partitions(clean(scan_raw_path(path), month, maintain_order=False), month, output_dir)
+        print(f'Cleaned {path} into {month_dir} ({n_districts} districts)')
+
+
+if __name__ == '__main__':
+    #python flats_cleaning.py [month] cleans one month into flats_{month}.csv, e.g. python flats_cleaning.py 2026-01
+    #python flats_cleaning.py --streaming [files] cleans the given (by default all) scraped files into flats_dataset
+    if len(sys.argv) > 1 and sys.argv[1] == '--streaming':
+        raw_paths = sys.argv[2:] or sorted(p for p in glob.glob('otodom_scraped_*') if os.path.isdir(p) or p.endswith('.csv'))
+        clean_streaming(raw_paths)
+    else:
+        clean_month(sys.argv[1] if len(sys.argv) > 1 else datetime.now().strftime('%Y-%m'))
@@ -0,0 +1,131 @@
+import glob
+import os
+import re
+import polars as pl
+from polars import col
+from flats_cleaning import dataset_dir, extra_bits
+
+#cleaned months are read from the parquet dataset written by flats_cleaning.py (flats_dataset/month=YYYY-MM/district=.../part-0.parquet),
+#months which are only in flats_YYYY-MM.csv files are read from the csv
+
+file_pattern = r'^flats_(20\d{2}-\d{2})\.csv$'
+
+#types of the cleaned columns, csv files are read with the types of the parquet files
+clean_schema = {
+    'id': pl.Int64,
+    'content_hash': pl.Int64,
+    'price': pl.Float64,
+    'rent': pl.Float64,
+    'area': pl.Float64,
+    'price_per_sq_m': pl.Float64,
+    'no_rooms': pl.Int64,
+    'building_type': pl.String,
+    'no_floor': pl.Int64,
+    'building_floors_num': pl.Int64,
+    'windows_type': pl.String,
+    'construction_status': pl.String,
+    'building_ownership': pl.String,
+    'lat': pl.Float64,
+    'long': pl.Float64,
+    'district': pl.String,
+    'built_year': pl.Int64,
+    'url': pl.String,
+    'rent_per_sq_m': pl.Float64,
+    'extras_mask': pl.Int16,
+    'is_primary': pl.Int8,
+    'date_scraped': pl.Date
+}
+
+
+def month_sources(directory='.'):
+    '''Source of every cleaned month, its dataset directory if there is one, the csv file otherwise'''
+    sources = {}
+    for filename in os.listdir(directory):
+        match = re.match(file_pattern, filename)
+        if match:
+            sources[match.group(1)] = os.path.join(directory, filename)
+    for month_dir in glob.glob(os.path.join(directory, dataset_dir, 'month=*')):
+        if os.path.isdir(month_dir):
+            sources[month_dir.rsplit('month=', 1)[-1]] = month_dir
+    return dict(sorted(sources.items()))
+
+
+def data_version(directory='.'):
+    '''Names, sizes and modification times of all source files, it changes whenever a month is added or cleaned again'''
+    paths = []
+    for source in month_sources(directory).values():
+        paths.extend(sorted(glob.glob(os.path.join(source, 'district=*', '*.parquet'))) if os.path.isdir(source) else [source])
+    version = []
+    for path in paths:
+        stat = os.stat(path)
+        version.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(version)
+
+
+def scan_csv(path, month):
+    flats = pl.scan_csv(path, separator=';', quote_char='"', schema_overrides=clean_schema)
+    names = flats.collect_schema().names()
+
+    #older files have one 0/1 column per extra instead of extras_mask and no content_hash
+    if 'extras_mask' not in names:
+        flag_cols = [f for f in extra_bits if f in names]
+        flats = flats.with_columns(
+            pl.sum_horizontal([col(f).fill_null(0).cast(pl.Int16) * extra_bits[f] for f in flag_cols] or [pl.lit(0, pl.Int16)])
+            .cast(pl.Int16)
+            .alias('extras_mask')
+        )
+    if 'content_hash' not in names:
+        flats = flats.with_columns(pl.lit(None, pl.Int64).alias('content_hash'))
+
+    return flats.with_columns(pl.lit(month).alias('month')).select(list(clean_schema) + ['month'])
+
+
+def scan_flats(directory='.'):
+    '''Lazy frame of all cleaned months with a month column, None when there is nothing to read'''
+    sources = month_sources(directory)
+    frames = []
+
+    #one scan of the whole dataset, filters on month and district only open the matching partitions
+    #and the min/max statistics of the files skip the rest
+    if any(os.path.isdir(source) for source in sources.values()):
+        frames.append(
+            pl.scan_parquet(
+                os.path.join(directory, dataset_dir, 'month=*', 'district=*', '*.parquet'),
+                hive_partitioning=True,
+                hive_schema={'month': pl.String, 'district': pl.String}
+            )
+            .select(list(clean_schema) + ['month'])
+        )
+    frames.extend(scan_csv(source, month) for month, source in sources.items() if not os.path.isdir(source))
+
+    if not frames:
+        return None
+    return pl.concat(frames, how='vertical')
+
+
+def current_offers(flats):
+    '''Latest version of every offer, as a semi join with the latest month of each id,
+    so filters applied afterwards still reach the scan (unlike unique(keep='last'))'''
+    latest = flats.select('id', 'month').group_by('id').agg(col('month').max())
+    return flats.join(latest, on=['id', 'month'], how='semi')
+
+
+def month_batches(source, batch_size):
+    '''Cleaned rows of one month in frames of at most batch_size rows, memory doesn't depend on the size of the month'''
+    if os.path.isdir(source):
+        #one district at a time, the district comes from the name of the directory
+        for path in sorted(glob.glob(os.path.join(source, 'district=*', '*.parquet'))):
+            district = os.path.basename(os.path.dirname(path)).split('=', 1)[1]
+            df = pl.read_parquet(path).with_columns(pl.lit(district).alias('district'))
+            yield from df.iter_slices(batch_size)
+        return
+
+    reader = pl.read_csv_batched(source, separator=';', quote_char='"', schema_overrides=clean_schema, batch_size=batch_size)
+    while batches := reader.next_batches(1):
+        yield batches[0]
+
+
+def collect(flats):
+    '''Collecting a query built on current_offers, without common subplan elimination, which would read the dataset once
+    for both sides of the join and so keep the filters from reaching the scan'''
+    return flats.collect(comm_subplan_elim=False)
@@ -0,0 +1,88 @@
+import polars as pl
+from polars import col
+from flats_cleaning import extra_bits, has_extras
+
+#filters of the dashboard are described once and compiled both to a polars expression (charts)
+#and to sql with bound parameters (top deals), so both sections always show the same offers
+
+#categorical columns, stored in the db as codes ({column}_id) of the dim_{column} tables
+category_columns = ['district', 'building_ownership', 'construction_status']
+#categories which are columns of the rollup tables too
+rollup_categories = ['district']
+
+
+class FilterSpec:
+    '''Filter state of the dashboard, hashable, so results can be cached per state'''
+    def __init__(self, categories=None, is_primary=None, ranges=None, extras=()):
+        #categories: {column: selected names}, ranges: {column: (min, max, keep_nulls)}, extras: features the offer must have
+        self.categories = tuple(sorted((c, tuple(sorted(v))) for c, v in (categories or {}).items() if v))
+        self.is_primary = is_primary
+        self.ranges = tuple(sorted((c, r) for c, r in (ranges or {}).items() if r[0] is not None and r[1] is not None))
+        self.extras = tuple(sorted(extras))
+
+    def key(self):
+        return (self.categories, self.is_primary, self.ranges, self.extras)
+
+    def __eq__(self, other):
+        return isinstance(other, FilterSpec) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def to_expr(self):
+        '''One polars expression for all filters'''
+        conditions = [col(c).is_in(list(names)) for c, names in self.categories]
+        if self.is_primary is not None:
+            conditions.append(col('is_primary') == self.is_primary)
+        for c, (low, high, keep_nulls) in self.ranges:
+            condition = col(c).is_between(low, high)
+            conditions.append(condition | col(c).is_null() if keep_nulls else condition)
+        if self.extras:
+            conditions.append(has_extras(self.extras))
+        return pl.all_horizontal(conditions) if conditions else pl.lit(True)
+
+    def to_sql(self, codes):
+        '''WHERE clause with ? placeholders and its parameters, codes are {column: {name: code}} of the dimension tables'''
+        conditions = []
+        params = []
+        for c, names in self.categories:
+            selected = [codes[c][n] for n in names if n in codes[c]]
+            if not selected:
+                #none of the names is in the db, so no offer can match
+                conditions.append('0')
+                continue
+            conditions.append(f"{c}_id IN ({', '.join(['?'] * len(selected))})")
+            params.extend(selected)
+        if self.is_primary is not None:
+            conditions.append('is_primary = ?')
+            params.append(self.is_primary)
+        for c, (low, high, keep_nulls) in self.ranges:
+            conditions.append(f'({c} BETWEEN ? AND ? OR {c} IS NULL)' if keep_nulls else f'{c} BETWEEN ? AND ?')
+            params.extend([low, high])
+        if self.extras:
+            bits = sum(extra_bits[f] for f in self.extras)
+            conditions.append('(extras_mask & ?) = ?')
+            params.extend([bits, bits])
+
+        where_clause = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return where_clause, tuple(params)
+
+    def rollup_row(self, bounds, codes):
+        '''(district_id, is_primary) of the rollup row holding exactly the filtered offers, -1 for all districts or markets,
+        None when no row does; bounds are {column: (min, max, null count)} of the range columns and {column: names}
+        of the category columns of all offers, codes are {column: {name: code}} of the dimension tables'''
+        if self.extras:
+            return None
+        for c, (low, high, keep_nulls) in self.ranges:
+            c_min, c_max, nulls = bounds[c]
+            if low > c_min or high < c_max or (nulls and not keep_nulls):
+                return None
+        district = -1
+        for c, names in self.categories:
+            #selecting every name is the same as no filter (the default of the dashboard)
+            if set(names) >= set(bounds[c]):
+                continue
+            if c not in rollup_categories or len(names) > 1 or names[0] not in codes[c]:
+                return None
+            district = codes[c][names[0]]
+        return district, -1 if self.is_primary is None else int(self.is_primary)
@@ -0,0 +1,37 @@
+import json
+
+#marker of the script tag in which next.js embeds the page data, the json inside can't contain '</script>' (next.js escapes '<')
+script_marker = b'id="__NEXT_DATA__"'
+script_end = b'</script>'
+page_props_prefix = '{"props":{"pageProps":{'
+
+decoder = json.JSONDecoder()
+
+
+def extract_next_data(page):
+    '''Slicing the text of the __NEXT_DATA__ script straight out of the page, without building a DOM'''
+    if isinstance(page, str):
+        page = page.encode('utf-8')
+
+    marker = page.find(script_marker)
+    if marker == -1:
+        return None
+
+    #json starts right after the end of the opening tag
+    start = page.find(b'>', marker) + 1
+    end = page.find(script_end, start)
+    if start == 0 or end == -1:
+        return None
+
+    return page[start:end].decode('utf-8')
+
+
+def parse_ad(next_data):
+    '''Parsing only props.pageProps.ad of an offer page, the rest of the (much bigger) json is skipped'''
+    #next.js puts pageProps first and the offer pages start it with the ad, then only the ad object is decoded
+    if next_data.startswith(page_props_prefix + '"ad":'):
+        ad, _ = decoder.raw_decode(next_data, len(page_props_prefix) + len('"ad":'))
+        return ad
+
+    #any other layout falls back to parsing everything
+    return json.loads(next_data)['props']['pageProps']['ad']
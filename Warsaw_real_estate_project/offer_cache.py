@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+
+class OfferCache:
+    '''Compressed on-disk cache of raw __NEXT_DATA__ payloads of offer pages, keyed by url'''
+    def __init__(self, directory, ttl_days=7, max_age_days=90, max_size_mb=1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        #entries younger than ttl are used without asking the server, older ones are revalidated
+        self.ttl = ttl_days * 24 * 3600
+        #entries older than max_age or above the size limit are removed by prune()
+        self.max_age = max_age_days * 24 * 3600
+        self.max_size = max_size_mb * 1024 * 1024
+
+    def path_for(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return self.directory / f'{key}.json.gz'
+
+    def get(self, url):
+        path = self.path_for(url)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, json.JSONDecodeError):
+            #broken entry (e.g. the run was killed while writing) is treated as a miss
+            return None
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def conditional_headers(self, entry):
+        '''Headers for revalidating a stale entry, so the server can answer 304 instead of sending the page'''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, district_name, payload, etag=None, last_modified=None):
+        entry = {
+            'url': url,
+            'district': district_name,
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'payload': payload
+        }
+        self.write(entry)
+        return entry
+
+    def touch(self, entry):
+        #server confirmed that the page didn't change, only the timestamp is refreshed
+        entry['fetched_at'] = time.time()
+        self.write(entry)
+
+    def write(self, entry):
+        path = self.path_for(entry['url'])
+        tmp_path = path.with_suffix('.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def prune(self):
+        '''Removing entries older than max_age, then the oldest ones until the cache fits in max_size'''
+        now = time.time()
+        files = []
+        for path in self.directory.glob('*.json.gz'):
+            stat = path.stat()
+            if now - stat.st_mtime > self.max_age:
+                path.unlink(missing_ok=True)
+            else:
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        #file mtime is updated on every write and touch, so it follows fetched_at without opening the files
+        total_size = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            removed += 1
+
+        if removed:
+            print(f'Removed {removed} offers from the cache to stay under {self.max_size // (1024 * 1024)} MB')
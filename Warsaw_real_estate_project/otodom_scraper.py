@@ -1,10 +1,18 @@
 import pandas as pd
+import sys
 import time
 import json
 import random
 from datetime import datetime
 import os
 import csv
+import shutil
+import sqlite3
+import signal
+import queue
+import multiprocessing
+import asyncio
+import aiohttp
 import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
@@ -15,6 +23,11 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 from pathlib import Path
+from offer_cache import OfferCache
+from next_data import extract_next_data, parse_ad
+from scrape_sinks import CsvSink, ParquetSink, read_scraped, row_schema
+from scrape_client import AdaptiveConcurrency, ScrapeMetrics, retry_delay, retry_statuses
+from flats_cleaning import url_key
 
 #path for chrome drivers (to check on your computer), put it inside the ''
 chromedriver_path = r''
@@ -31,6 +44,27 @@ filename = f'otodom_scraped_{month}.csv'
 #connecting paths
 output_dir = base_dir / filename
 
+#'parquet' saves typed batches as part files of the otodom_scraped_{month} directory, 'csv' appends to the csv file above
+output_format = 'parquet'
+parquet_dir = base_dir / f'otodom_scraped_{month}'
+
+#journal of finished pages and districts, delete it to scrape the month from scratch
+progress_path = base_dir / f'otodom_progress_{month}.jsonl'
+
+#incremental mode only downloads offers which are not in the db or previous scrapes (or whose price changed),
+#offers seen again are listed in the active file instead
+incremental = False
+active_path = base_dir / f'otodom_active_{month}.csv'
+db_path = base_dir / 'warsaw_flats.db'
+
+#requests, retries, statuses and latency percentiles per district are saved here at the end of the run
+metrics_path = base_dir / f'otodom_metrics_{month}.json'
+
+#raw __NEXT_DATA__ of downloaded offers is kept on disk, so reruns and new columns don't need the network
+#(python otodom_scraper.py --from-cache rebuilds the rows of the month from it)
+use_cache = True
+cache = OfferCache(base_dir / 'offer_cache', ttl_days=7, max_age_days=90, max_size_mb=1024) if use_cache else None
+
 #splitting scraping into districts to make it more efficient and error proof
 districts = [
     'bemowo', 
@@ -62,6 +96,23 @@ session.headers.update({
     'Referer': 'https://www.otodom.pl/'
 })
 
+#politeness budget for offer details - how many requests per second can be started and how many can be in flight per host at once
+requests_per_second = 2
+max_in_flight_per_host = 6
+
+#throttled (429/503), failed and timed out requests are retried with exponential backoff, honouring Retry-After
+max_retries = 4
+
+#'http' reads search results from the __NEXT_DATA__ json over plain requests, 'selenium' renders them in chrome (fallback, needs chromedriver_path)
+listing_mode = 'http'
+
+#number of offers per results page in http mode (otodom accepts up to 72), fewer pages means fewer listing requests
+listing_page_size = 72
+
+#number of districts scraped at the same time in separate processes, requests_per_second and max_in_flight_per_host
+#stay the limits for all of them together (the requests in flight are split between the processes)
+district_workers = 4
+
 def setup_driver():
     '''Setting up driver and chrome options'''
     chrome_options = Options()
@@ -131,65 +182,234 @@ def collect_offer_links(driver):
             urls.add(full_url)
     return list(urls)
 
-def get_offer_details_fast(url, district_name):
-   
+class RateLimiter:
+    '''Spacing request starts evenly so that no more than `rate` requests per second are sent'''
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+
+    def reserve(self):
+        #reserving the next free slot and returning how long to wait for it, so concurrent callers queue up one interval apart
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        return slot - now
+
+    async def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def wait_blocking(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+class SharedTokenBucket(RateLimiter):
+    '''Token bucket kept in shared memory, so worker processes draw from one requests per second budget'''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = multiprocessing.Lock()
+        self.tokens = multiprocessing.RawValue('d', burst)
+        #wall clock is used since monotonic clocks are not guaranteed to be comparable between processes
+        self.updated = multiprocessing.RawValue('d', time.time())
+
+    def reserve(self):
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value + (now - self.updated.value) * self.rate) - 1
+            self.tokens.value = tokens
+            self.updated.value = now
+        #negative balance means that the taken token is refilled only after -tokens/rate seconds
+        return max(0.0, -tokens / self.rate)
+
+#one limiter for the whole run, so the budget holds across pages and districts (replaced by the shared bucket in worker processes)
+limiter = RateLimiter(requests_per_second)
+
+#requests in flight adapt between 1 and in_flight_limit to how quickly the site answers,
+#a worker process gets its share of max_in_flight_per_host (set again in init_worker)
+in_flight_limit = max_in_flight_per_host
+concurrency = AdaptiveConcurrency(in_flight_limit)
+metrics = ScrapeMetrics()
+
+def row_from_next_data(next_data, url, district_name):
+    '''Building a row from the __NEXT_DATA__ json embedded in the offer page'''
+    #setting correct logic to pull the desired data
+    ad = parse_ad(next_data)
+    target = ad.get('target', {})
+    add_info = {c['label']: c['values'] for c in ad.get('additionalInformation', [])}
+    chars = {c['key']: c['value'] for c in ad.get('characteristics', [])}
+    loc = ad.get('location', {})
+    cords = loc.get('coordinates', {})
+    
+    lat = cords.get('latitude')
+    long = cords.get('longitude')
+
+    row = {
+        'price': chars.get('price'),
+        'rent': chars.get('rent'),
+        'area': chars.get('m'),
+        'extras': ", ".join(target.get('Extras_types', [])) if target and target.get('Extras_types') else None, #extras are represented in a list of values, so we put them into comma separated value so we can save it to csv
+        'price_per_sq_m': chars.get('price_per_m'),
+        'no_rooms': chars.get('rooms_num'),
+        'market_type': chars.get('market'),
+        'building_type': chars.get('building_type'),
+        'no_floor': chars.get('floor_no'),
+        'building_floors_num': chars.get('building_floors_num'),
+        'windows_type': chars.get('windows_type'),
+        'construction_status': chars.get('construction_status'),
+        'building_ownership': chars.get('building_ownership'),
+        'lat': lat,
+        'long': long,
+        'district': district_name,
+        'built_year': add_info.get('build_year')[0] if add_info.get('build_year') else None,
+        'url': url
+    }
+    return row
+
+async def request_offer(client, url, headers, district_name):
+    '''One request through the rate limiter and the adaptive concurrency limit, returns (status, body, headers)'''
+    await limiter.wait()
+    await concurrency.acquire()
+    
+    status, html, response_headers = None, b'', {}
+    start = time.monotonic()
     try:
-        #getting html
-        response = session.get(url, timeout=10)
+        async with client.get(url, headers=headers) as response:
+            status = response.status
+            response_headers = response.headers
+            if status == 200:
+                html = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f'Request error {url}: {e!r}')
+    finally:
+        latency = time.monotonic() - start
+        concurrency.release(status, latency)
+        metrics.record(district_name, status, latency, len(html))
+    
+    return status, html, response_headers
+
+async def fetch_offer_details(client, url, district_name):
+    '''Row of one offer page, with the cache, retries and backoff'''
+    entry = cache.get(url) if cache else None
+    
+    #fresh entries don't need the network at all
+    if entry and cache.is_fresh(entry):
+        metrics.cache_hit(district_name)
+        return row_from_next_data(entry['payload'], url, district_name)
+    
+    headers = cache.conditional_headers(entry) if entry else {}
+    for attempt in range(max_retries + 1):
+        status, html, response_headers = await request_offer(client, url, headers, district_name)
         
-        if response.status_code != 200:
-            print(f"Status code error: {response.status_code}")
+        if status in retry_statuses and attempt < max_retries:
+            metrics.retry(district_name)
+            await asyncio.sleep(retry_delay(attempt, response_headers.get('Retry-After')))
+            continue
+        break
+    
+    try:
+        if status == 304 and entry:
+            cache.touch(entry)
+            return row_from_next_data(entry['payload'], url, district_name)
+        if status != 200:
+            print(f"Status code error: {status} {url}")
             return None
 
-        soup = BeautifulSoup(response.text, 'html.parser')
-        script_tag = soup.find('script', id='__NEXT_DATA__')
+        next_data = extract_next_data(html)
+        if not next_data:
+            return None
         
-        if script_tag:
-            data_json = json.loads(script_tag.string)
-            
-           #setting correct logic to pull the desired data
-            ad = data_json['props']['pageProps']['ad']
-            target = ad.get('target', {})
-            add_info = {c['label']: c['values'] for c in ad.get('additionalInformation', [])}
-            chars = {c['key']: c['value'] for c in ad.get('characteristics', [])}
-            loc = ad.get('location', {})
-            cords = loc.get('coordinates', {})
-            
-            lat = cords.get('latitude')
-            long = cords.get('longitude')
-
-            row = {
-                'price': chars.get('price'),
-                'rent': chars.get('rent'),
-                'area': chars.get('m'),
-                'extras': ", ".join(target.get('Extras_types', [])) if target and target.get('Extras_types') else None, #extras are represented in a list of values, so we put them into comma separated value so we can save it to csv
-                'price_per_sq_m': chars.get('price_per_m'),
-                'no_rooms': chars.get('rooms_num'),
-                'market_type': chars.get('market'),
-                'building_type': chars.get('building_type'),
-                'no_floor': chars.get('floor_no'),
-                'building_floors_num': chars.get('building_floors_num'),
-                'windows_type': chars.get('windows_type'),
-                'construction_status': chars.get('construction_status'),
-                'building_ownership': chars.get('building_ownership'),
-                'lat': lat,
-                'long': long,
-                'district': district_name,
-                'built_year': add_info.get('build_year')[0] if add_info.get('build_year') else None,
-                'url': url
-            }
-            return row
-            
+        if cache:
+            cache.put(url, district_name, next_data, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+        return row_from_next_data(next_data, url, district_name)
+
     except Exception as e:
         print(f'Error while scraping details {url}: {e}')
         return None
 
-def scrape_district(district_name):
-    print(f'\n Starting scraping: {district_name}')
-    
-    #core url for scraping different districts
-    base_url = f'https://www.otodom.pl/pl/wyniki/sprzedaz/mieszkanie/mazowieckie/warszawa/warszawa/warszawa/{district_name}'
+async def fetch_offers_async(links, district_name):
+    #same headers as the requests session, limit of open connections per host keeps the number of requests in flight bounded
+    connector = aiohttp.TCPConnector(limit_per_host=in_flight_limit)
+    timeout = aiohttp.ClientTimeout(total=10)
+
+    async with aiohttp.ClientSession(headers=dict(session.headers), connector=connector, timeout=timeout) as client:
+        results = await asyncio.gather(*(fetch_offer_details(client, link, district_name) for link in links))
+
+    #gather keeps the order of links, failed offers are dropped
+    return [row for row in results if row]
+
+def get_offers_details(links, district_name):
+    '''Downloading details of many offers concurrently, one row per offer that could be read'''
+    return asyncio.run(fetch_offers_async(links, district_name))
+
+def parse_listing_page(html):
+    '''Getting offer links with their listed prices and the number of result pages from the __NEXT_DATA__ json of a search results page'''
+    next_data = extract_next_data(html)
+
+    if not next_data:
+        return {}, 0
+
+    data_json = json.loads(next_data)
+    search_ads = data_json['props']['pageProps']['data']['searchAds']
+
+    base_url = 'https://www.otodom.pl'
+    offers = {}
+    for item in search_ads.get('items') or []:
+        #slug is the last part of the offer link, href is kept as a backup with a '[lang]/ad/' placeholder
+        if item.get('slug'):
+            url = f"{base_url}/pl/oferta/{item['slug']}"
+        elif item.get('href'):
+            url = f"{base_url}/{item['href'].replace('[lang]/ad/', 'pl/oferta/').lstrip('/')}"
+        else:
+            continue
+        offers[url] = (item.get('totalPrice') or {}).get('value')
+
+    total_pages = (search_ads.get('pagination') or {}).get('totalPages') or 1
+    return offers, total_pages
+
+def get_listing_page(base_url, page, district_name):
+    for attempt in range(max_retries + 1):
+        limiter.wait_blocking()
+        
+        response = None
+        start = time.monotonic()
+        try:
+            response = session.get(base_url, params={'limit': listing_page_size, 'page': page}, timeout=10)
+        except requests.RequestException as e:
+            print(f'Request error {base_url} page {page}: {e!r}')
+        
+        status = response.status_code if response is not None else None
+        metrics.record(district_name, status, time.monotonic() - start, len(response.content) if response is not None else 0)
+        
+        if status in retry_statuses and attempt < max_retries:
+            metrics.retry(district_name)
+            time.sleep(retry_delay(attempt, response.headers.get('Retry-After') if response is not None else None))
+            continue
+        break
     
+    if response is None:
+        raise RuntimeError(f'No response for page {page} after {max_retries} retries')
+    response.raise_for_status()
+    return parse_listing_page(response.content)
+
+def listing_pages_http(base_url, skip_pages, district_name):
+    '''Yielding (page, max_pages, offers) for every results page, downloaded without a browser'''
+    offers, max_pages = get_listing_page(base_url, 1, district_name)
+    print(f'Pages found: {max_pages}')
+
+    for page in range(1, max_pages + 1):
+        if page in skip_pages:
+            continue
+        print(f'Downloading page: {page}/{max_pages}')
+        #first page was already downloaded to get the number of pages
+        if page > 1:
+            offers, _ = get_listing_page(base_url, page, district_name)
+        yield page, max_pages, offers
+
+def listing_pages_selenium(base_url, skip_pages, district_name):
+    '''Yielding (page, max_pages, offers) for every results page rendered in chrome, prices are not read from the page'''
     driver = setup_driver()
     
     try:
@@ -198,9 +418,10 @@ def scrape_district(district_name):
         time.sleep(2)
         
         max_pages = select_max_pages(driver)
-        print(f'District {district_name}: {max_pages} found to download.')
         
         for page in range(1, max_pages + 1):
+            if page in skip_pages:
+                continue
             separator = '&' if '?' in base_url else '?'
             current_page_url = f"{base_url}{separator}page={page}"
             
@@ -210,57 +431,369 @@ def scrape_district(district_name):
             
             time.sleep(random.uniform(3, 5))
             
-            links = collect_offer_links(driver)
+            yield page, max_pages, dict.fromkeys(collect_offer_links(driver))
+
+    finally:
+        driver.quit()
+
+class ProgressJournal:
+    '''Append-only journal of finished pages, districts and downloaded offers, so an interrupted run can be resumed'''
+    def __init__(self, path):
+        self.path = path
+        self.districts_done = set()
+        self.pages_done = {}
+        self.fetched_urls = set()
+        #entries wait here until the rows they describe are flushed by the sink
+        self.pending = []
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        #last line can be cut off if the run was killed while writing it
+                        continue
+                    if entry['event'] == 'page':
+                        self.pages_done.setdefault(entry['district'], set()).add(entry['page'])
+                        self.fetched_urls.update(entry['urls'])
+                    elif entry['event'] == 'district':
+                        self.districts_done.add(entry['district'])
+
+    def seed_from_csv(self, path):
+        #offers saved to the files right before a crash may be missing from the journal
+        if os.path.exists(path):
+            saved = pd.read_csv(path, sep=';', usecols=['url'], encoding='utf-8-sig')
+            self.fetched_urls.update(saved['url'].dropna())
+
+    def commit(self):
+        #flushing entries to disk only after the sink saved the rows, so the journal never claims more than what was saved
+        if not self.pending:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in self.pending:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def page_done(self, district_name, page, urls):
+        self.pages_done.setdefault(district_name, set()).add(page)
+        self.fetched_urls.update(urls)
+        self.pending.append({'event': 'page', 'district': district_name, 'page': page, 'urls': list(urls)})
+
+    def district_done(self, district_name):
+        self.districts_done.add(district_name)
+        self.pending.append({'event': 'district', 'district': district_name})
+
+def load_known_offers():
+    '''Last known price of every offer in the db and in the previous months' scrapes, by the otodom id of its url
+    (an offer can be stored with its /hpr/pl/oferta/ url and listed with its /pl/oferta/ one)'''
+    known = {}
+
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            known.update((url_key(url), price) for url, price in conn.execute('SELECT url, price FROM flats ORDER BY date_scraped'))
+        except sqlite3.Error as e:
+            print(f'Could not read offers from db: {e}')
+        finally:
+            conn.close()
+
+    #months are sorted by name, so the newest price wins (csv files and parquet directories alike)
+    for path in sorted(base_dir.glob('otodom_scraped_*'), key=lambda p: p.stem):
+        if path.stem == parquet_dir.name or not (path.is_dir() or path.suffix == '.csv'):
+            continue
+        previous = read_scraped(path, ['url', 'price'])
+        known.update(zip(map(url_key, previous['url'].to_list()), previous['price'].to_list()))
+
+    print(f'{len(known)} offers known from previous runs')
+    return known
+
+def is_unchanged(known, url, listed_price):
+    #without a listed price (selenium listing) only the offer id can be compared
+    key = url_key(url)
+    if key not in known:
+        return False
+    if listed_price is None or pd.isna(known[key]):
+        return True
+    return float(listed_price) == float(known[key])
+
+def append_to_csv(rows, path):
+    df = pd.DataFrame(rows)
+    header_mode = not os.path.exists(path)
+    df.to_csv(
+        path, 
+        mode='a', 
+        index=False, 
+        header=header_mode, 
+        encoding='utf-8-sig',
+        sep=';',                  
+        quoting=csv.QUOTE_ALL, 
+        lineterminator='\n'      
+    )
+
+def scrape_district(district_name, skip_pages, fetched_urls, known, emit):
+    '''Scraping one district, saved pages are passed to emit as events instead of being written here'''
+    print(f'\n Starting scraping: {district_name}')
+    
+    #core url for scraping different districts
+    base_url = f'https://www.otodom.pl/pl/wyniki/sprzedaz/mieszkanie/mazowieckie/warszawa/warszawa/warszawa/{district_name}'
+    
+    listing_pages = listing_pages_selenium if listing_mode == 'selenium' else listing_pages_http
+    
+    if skip_pages:
+        print(f'Resuming {district_name}, {len(skip_pages)} pages already done')
+    
+    try:
+        for page, max_pages, offers in listing_pages(base_url, skip_pages, district_name):
             
-            if not links:
-                print('No links on the page')
-                continue
+            #offers downloaded earlier in this run or before a restart are not downloaded again
+            offers = {url: price for url, price in offers.items() if url not in fetched_urls}
             
-            page_data = []
-            for link in links:
-                details = get_offer_details_fast(link, district_name)
-                if details:
-                    page_data.append(details)
-                time.sleep(random.uniform(0.8, 1.5))
+            #in incremental mode offers already known with the same price are only marked as still active
+            active = []
+            if known is not None:
+                active = [
+                    {'url': url, 'district': district_name, 'price': price if price is not None else known[url_key(url)]}
+                    for url, price in offers.items() if is_unchanged(known, url, price)
+                ]
+                
+            active_urls = {row['url'] for row in active}
+            links = [url for url in offers if url not in active_urls]
+            
+            page_data = get_offers_details(links, district_name) if links else []
+            fetched_urls.update(row['url'] for row in page_data + active)
             
-            #saving data after each page
-            if page_data:
-                df = pd.DataFrame(page_data)
-                header_mode = not os.path.exists(output_dir)
-                df.to_csv(
-                    output_dir, 
-                    mode='a', 
-                    index=False, 
-                    header=header_mode, 
-                    encoding='utf-8-sig',
-                    sep=';',                  
-                    quoting=csv.QUOTE_ALL, 
-                    lineterminator='\n'      
-                )
-                print(f'Saved {len(page_data)} offers to the file.')
+            if not offers:
+                print('No new links on the page')
+            
+            emit(('page', district_name, page, page_data, active))
+        
+        emit(('district', district_name))
+        print(f'Succesfully scraped {district_name}')
                 
     except Exception as e:
         print(f'Error while scraping {district_name}: {e}')
     finally:
-        driver.quit()
-        print(f'Succesfully scraped {district_name}')
+        summary = metrics.summary(district_name)
+        print(f'Requests for {district_name}: {summary}')
+        emit(('metrics', district_name, summary))
+
+#metrics summaries sent by the districts, saved to metrics_path at the end of the run
+run_metrics = {}
+
+def save_event(journal, sink, event):
+    '''Writing a page or district event to the files and the journal, only done by one process'''
+    if event[0] == 'district':
+        journal.district_done(event[1])
+        return
+    if event[0] == 'metrics':
+        run_metrics[event[1]] = event[2]
+        return
+
+    _, district_name, page, page_data, active = event
+    
+    #districts scraped in parallel can find the same offer, only the first copy is saved
+    page_data = [row for row in page_data if row['url'] not in journal.fetched_urls]
+    active = [row for row in active if row['url'] not in journal.fetched_urls]
+    
+    #rows are buffered by the sink, the journal entry is written after they are flushed
+    sink.write(page_data)
+    if active:
+        append_to_csv(active, active_path)
+        print(f'{len(active)} offers from {district_name} unchanged since the last run.')
+    
+    journal.page_done(district_name, page, [row['url'] for row in page_data + active])
+
+def init_worker(shared_limiter, worker_in_flight, events_queue, fetched_urls, known):
+    #ctrl+c is handled by the main process, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global limiter, in_flight_limit, concurrency, events, worker_fetched_urls, worker_known
+    limiter = shared_limiter
+    in_flight_limit = worker_in_flight
+    concurrency = AdaptiveConcurrency(worker_in_flight)
+    events = events_queue
+    worker_fetched_urls = fetched_urls
+    worker_known = known
+
+def district_worker(task):
+    district_name, skip_pages = task
+    try:
+        scrape_district(district_name, skip_pages, worker_fetched_urls, worker_known, events.put)
+        
+        #a longer break between districts is only needed when chrome is clicking through the site
+        if listing_mode == 'selenium':
+            time.sleep(random.uniform(10, 20))
+    finally:
+        events.put(('finished', district_name))
+
+def scrape_parallel(journal, sink, known, tasks):
+    '''Scraping districts in worker processes, rows come back through a queue and only this process writes them'''
+    events_queue = multiprocessing.Queue()
+    shared_limiter = SharedTokenBucket(requests_per_second)
+    
+    #every process gets an equal share of the requests in flight, at least one, so there are never more processes than max_in_flight_per_host
+    workers = min(district_workers, len(tasks), max_in_flight_per_host)
+    pool = multiprocessing.Pool(
+        workers,
+        initializer=init_worker,
+        initargs=(shared_limiter, max_in_flight_per_host // workers, events_queue, journal.fetched_urls, known)
+    )
+    try:
+        result = pool.map_async(district_worker, tasks, chunksize=1)
+        finished = 0
+        while finished < len(tasks):
+            try:
+                event = events_queue.get(timeout=1)
+            except queue.Empty:
+                #all tasks returned, but some of them died before reporting
+                if result.ready():
+                    break
+                continue
+            
+            if event[0] == 'finished':
+                finished += 1
+            else:
+                save_event(journal, sink, event)
+        pool.close()
+        
+    except KeyboardInterrupt:
+        print('\nStopped by the user')
+        pool.terminate()
+    except BaseException:
+        #workers are stopped on any error, join() would otherwise wait for all the districts
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 def main():
     print('Starting scraping')
     
+    journal = ProgressJournal(progress_path)
+    
+    if output_format == 'parquet':
+        sink = ParquetSink(parquet_dir, on_flush=journal.commit)
+    else:
+        sink = CsvSink(output_dir, on_flush=journal.commit)
+    
+    #offers saved right before a crash may be missing from the journal
+    journal.fetched_urls.update(sink.saved_urls())
+    journal.seed_from_csv(active_path)
+    
+    known = load_known_offers() if incremental else None
+    
+    #metrics of districts finished before a restart are kept
+    if os.path.exists(metrics_path):
+        with open(metrics_path, encoding='utf-8') as f:
+            run_metrics.update(json.load(f))
+    
+    tasks = []
     for district in districts:
-        try:
-            scrape_district(district)
+        if district in journal.districts_done:
+            print(f'Skipping {district}, already scraped this month')
+            continue
+        tasks.append((district, journal.pages_done.get(district, set())))
+    
+    try:
+        if district_workers > 1 and len(tasks) > 1:
+            scrape_parallel(journal, sink, known, tasks)
+        else:
+            for district, skip_pages in tasks:
+                try:
+                    #scrape_district marks urls in its own copy, the journal's set is only updated by save_event
+                    scrape_district(district, skip_pages, set(journal.fetched_urls), known, lambda event: save_event(journal, sink, event))
 
-            time.sleep(random.uniform(10, 20))
-            
-        except KeyboardInterrupt:
-            print('\nStopped by the user')
-            break
-        except Exception as e:
-            print(f'Error while scraping {e}')
+                    #a longer break between districts is only needed when chrome is clicking through the site
+                    if listing_mode == 'selenium':
+                        time.sleep(random.uniform(10, 20))
+                    
+                except KeyboardInterrupt:
+                    print('\nStopped by the user')
+                    break
+                except Exception as e:
+                    print(f'Error while scraping {e}')
+    finally:
+        #buffered rows are saved also when the run is interrupted or fails
+        sink.close()
+
+    if cache:
+        cache.prune()
+
+    if run_metrics:
+        with open(metrics_path, 'w', encoding='utf-8') as f:
+            json.dump(run_metrics, f, indent=2)
+        print(f'Request metrics saved to {metrics_path}')
 
     print('\n Scraping finished')
 
+def rebuild_from_cache():
+    '''Building the rows of this month's offers again from the cached payloads, without any requests,
+    the month's output (parquet directory or csv) is replaced, so the cleaning step reads the new rows'''
+    if not cache:
+        print('The cache is off (use_cache = False), nothing to rebuild from')
+        return
+
+    #offers of the month: everything the journal saved and the rows already in the output,
+    #offers only marked as active were not downloaded this month and stay in the active file
+    journal = ProgressJournal(progress_path)
+    output_path = parquet_dir if output_format == 'parquet' else output_dir
+    existing = {}
+    if output_path.exists():
+        for row in read_scraped(output_path, list(row_schema)).to_dicts():
+            existing.setdefault(row['url'], row)
+    urls = journal.fetched_urls | set(existing) - {None}
+    if os.path.exists(active_path):
+        urls -= set(pd.read_csv(active_path, sep=';', usecols=['url'], encoding='utf-8-sig')['url'].dropna())
+
+    #an offer whose page is not in the cache (not downloaded with it or removed by prune) keeps its row from the output
+    rows = []
+    rebuilt = kept = lost = 0
+    for url in sorted(urls):
+        entry = cache.get(url)
+        if entry is not None:
+            try:
+                rows.append(row_from_next_data(entry['payload'], entry['url'], entry['district']))
+                rebuilt += 1
+                continue
+            except Exception as e:
+                print(f"Error while parsing cached {entry['url']}: {e}")
+        if url in existing:
+            rows.append(existing[url])
+            kept += 1
+        else:
+            lost += 1
+
+    if not rebuilt:
+        print(f'No cached offers for {month}, {output_path} was left as it is')
+        return
+
+    #written next to the output first and swapped in at the end, an interrupted rebuild keeps the old rows
+    rebuilt_path = output_path.with_name(output_path.name + '.rebuild')
+    old_path = output_path.with_name(output_path.name + '.old')
+    for path in (rebuilt_path, old_path):
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+    sink = ParquetSink(rebuilt_path) if output_format == 'parquet' else CsvSink(rebuilt_path)
+    sink.write(rows)
+    sink.close()
+
+    #the old output is moved aside before the new one takes its place, so one of them is always on disk
+    if output_path.exists():
+        os.replace(output_path, old_path)
+    os.replace(rebuilt_path, output_path)
+    if old_path.is_dir():
+        shutil.rmtree(old_path)
+    elif old_path.exists():
+        old_path.unlink()
+    print(f'Rebuilt {rebuilt} offers from the cache into {output_path}, kept {kept} rows of offers which are not in the cache'
+          + (f', {lost} offers of the journal are neither in the cache nor in the output' if lost else ''))
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if '--from-cache' in sys.argv:
+        rebuild_from_cache()
+    else:
+        main()
\ No newline at end of file
@@ -29,8 +29,9 @@ def main():
 
 
     #----------- CLEANING -----------
+    #cleaning rules of Cleaning.ipynb as a lazy polars plan, the notebook is kept for the EDA
     run_command(
-        f'{python_cmd} -m jupyter nbconvert --to notebook --execute --inplace Cleaning.ipynb',
+        f'{python_cmd} flats_cleaning.py',
         'Cleaning and processing data'
     )
 
@@ -0,0 +1,124 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+
+#statuses worth another try, otodom answers 429/503 when it throttles, None stands for timeouts and connection errors
+retry_statuses = {None, 408, 429, 500, 502, 503, 504}
+throttle_statuses = {None, 429, 503}
+
+
+def parse_retry_after(value):
+    '''Retry-After header in seconds, it can be given as a number of seconds or as an http date'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None, base=1.0, cap=60.0):
+    '''Exponential backoff with full jitter, never shorter than what the server asked for in Retry-After'''
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    server_delay = parse_retry_after(retry_after)
+    if server_delay is not None:
+        delay = max(delay, min(server_delay, cap))
+    return delay
+
+
+class AdaptiveConcurrency:
+    '''Limit of requests in flight that grows while the site answers quickly and halves when it throttles or slows down'''
+    def __init__(self, max_limit, min_limit=1, slow_seconds=3.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.slow_seconds = slow_seconds
+        self.limit = max(min_limit, max_limit // 2)
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+
+    async def acquire(self):
+        #polling keeps the object usable from every event loop, asyncio.run creates a new one for each page
+        while self.in_flight >= self.limit:
+            await asyncio.sleep(0.05)
+        self.in_flight += 1
+
+    def release(self, status, latency):
+        self.in_flight -= 1
+
+        if status in throttle_statuses:
+            #halving at most once per second, otherwise one burst of errors would drop the limit to the minimum
+            now = time.monotonic()
+            if now - self.last_decrease > 1:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self.last_decrease = now
+            self.successes = 0
+        elif latency > self.slow_seconds:
+            self.limit = max(self.min_limit, self.limit - 1)
+            self.successes = 0
+        else:
+            #one more slot after a full window of quick answers
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1)
+                self.successes = 0
+
+
+class ScrapeMetrics:
+    '''Counters of requests, retries, statuses, bytes and latencies per district'''
+    def __init__(self):
+        self.districts = {}
+
+    def district(self, district_name):
+        if district_name not in self.districts:
+            self.districts[district_name] = {
+                'requests': 0,
+                'retries': 0,
+                'cache_hits': 0,
+                'bytes': 0,
+                'statuses': Counter(),
+                'latencies': [],
+                'started': time.time()
+            }
+        return self.districts[district_name]
+
+    def record(self, district_name, status, latency, size=0):
+        stats = self.district(district_name)
+        stats['requests'] += 1
+        stats['bytes'] += size
+        stats['statuses'][str(status) if status else 'error'] += 1
+        stats['latencies'].append(latency)
+
+    def retry(self, district_name):
+        self.district(district_name)['retries'] += 1
+
+    def cache_hit(self, district_name):
+        self.district(district_name)['cache_hits'] += 1
+
+    def summary(self, district_name):
+        '''Plain dict with the counters and latency percentiles, small enough to send between processes'''
+        stats = self.district(district_name)
+        latencies = sorted(stats['latencies'])
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3)
+
+        return {
+            'requests': stats['requests'],
+            'retries': stats['retries'],
+            'cache_hits': stats['cache_hits'],
+            'mb': round(stats['bytes'] / 1024 / 1024, 2),
+            'statuses': dict(stats['statuses']),
+            'p50_s': percentile(0.5),
+            'p90_s': percentile(0.9),
+            'p99_s': percentile(0.99),
+            'duration_s': round(time.time() - stats['started'], 1)
+        }
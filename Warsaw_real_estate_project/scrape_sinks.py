@@ -0,0 +1,121 @@
+import csv
+import os
+from pathlib import Path
+import pandas as pd
+import polars as pl
+
+#types of the scraped columns, same as the schema used when the raw file is loaded for cleaning
+row_schema = {
+    'price': pl.Float64,
+    'rent': pl.Float64,
+    'area': pl.Float64,
+    'extras': pl.String,
+    'price_per_sq_m': pl.Float64,
+    'no_rooms': pl.String,
+    'market_type': pl.String,
+    'building_type': pl.String,
+    'no_floor': pl.String,
+    'building_floors_num': pl.Int64,
+    'windows_type': pl.String,
+    'construction_status': pl.String,
+    'building_ownership': pl.String,
+    'lat': pl.Float64,
+    'long': pl.Float64,
+    'district': pl.String,
+    'built_year': pl.Int64,
+    'url': pl.String
+}
+
+
+class RowSink:
+    '''Buffering scraped rows and writing them in batches, on_flush is called once the rows are on disk'''
+    def __init__(self, batch_size=500, on_flush=None):
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.buffer = []
+
+    def write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write_batch(self.buffer)
+            print(f'Saved {len(self.buffer)} offers to the file.')
+            self.buffer = []
+        #called even without new rows, so pages with nothing to save are confirmed too
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        self.flush()
+
+    def write_batch(self, rows):
+        raise NotImplementedError
+
+    def saved_urls(self):
+        raise NotImplementedError
+
+
+class CsvSink(RowSink):
+    '''Appending batches to one csv file, in the format the scraper always used'''
+    def __init__(self, path, batch_size=500, on_flush=None):
+        super().__init__(batch_size, on_flush)
+        self.path = path
+
+    def write_batch(self, rows):
+        df = pd.DataFrame(rows, columns=list(row_schema))
+        header_mode = not os.path.exists(self.path)
+        df.to_csv(
+            self.path,
+            mode='a',
+            index=False,
+            header=header_mode,
+            encoding='utf-8-sig',
+            sep=';',
+            quoting=csv.QUOTE_ALL,
+            lineterminator='\n'
+        )
+
+    def saved_urls(self):
+        if not os.path.exists(self.path):
+            return []
+        return pd.read_csv(self.path, sep=';', usecols=['url'], encoding='utf-8-sig')['url'].dropna().tolist()
+
+
+class ParquetSink(RowSink):
+    '''Writing every batch as a new typed parquet file of one dataset directory (part-00000.parquet, part-00001.parquet, ...)'''
+    def __init__(self, directory, batch_size=500, on_flush=None):
+        super().__init__(batch_size, on_flush)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        #a resumed run continues the numbering
+        self.part = len(list(self.directory.glob('part-*.parquet')))
+
+    def write_batch(self, rows):
+        #values come as text from the page json, everything that can't be cast becomes null like in the csv
+        df = pl.DataFrame(
+            [{k: None if row.get(k) is None else str(row[k]) for k in row_schema} for row in rows],
+            schema={k: pl.String for k in row_schema}
+        ).cast(row_schema, strict=False)
+
+        #writing to a temporary name first, so an interrupted write never leaves a broken part
+        path = self.directory / f'part-{self.part:05d}.parquet'
+        tmp_path = path.with_suffix('.tmp')
+        df.write_parquet(tmp_path, statistics=True)
+        os.replace(tmp_path, path)
+        self.part += 1
+
+    def saved_urls(self):
+        if self.part == 0:
+            return []
+        return pl.read_parquet(self.directory / 'part-*.parquet', columns=['url'])['url'].drop_nulls().to_list()
+
+
+def read_scraped(path, columns):
+    '''Reading columns of a scraped month saved either as a csv file or as a parquet directory'''
+    path = Path(path)
+    if path.is_dir():
+        return pl.read_parquet(path / 'part-*.parquet', columns=columns)
+    return pl.read_csv(path, separator=';', quote_char='"', columns=columns, schema_overrides={c: row_schema[c] for c in columns})
@@ -0,0 +1,57 @@
+import polars as pl
+import polars.selectors as cs
+from polars import col
+from flats_cleaning import clean, clean_streaming, scan_raw_path, row_schema, extras_mask, extra_bits
+
+header = list(row_schema)
+
+
+def raw_row(district, url, price=800000):
+    values = {
+        'price': price, 'rent': 600, 'area': 50, 'extras': 'balcony, lift', 'price_per_sq_m': price / 50, 'no_rooms': '2',
+        'market_type': 'secondary', 'building_type': 'block', 'no_floor': 'floor_2', 'building_floors_num': 5,
+        'windows_type': 'plastic', 'construction_status': 'ready_to_use', 'building_ownership': 'full_ownership',
+        'lat': 52.23, 'long': 21.01, 'district': district, 'built_year': 2005, 'url': url
+    }
+    return [values[c] for c in header]
+
+
+def write_raw(path, rows):
+    pl.DataFrame(rows, schema=header, orient='row').write_csv(path, separator=';', quote_style='always')
+
+
+def test_clean_streaming_keeps_one_copy_of_duplicated_offers(tmp_path):
+    offer = 'https://www.otodom.pl/pl/oferta/dwa-pokoje-ID4abcd'
+    rows = [
+        #the same offer listed in two districts, only one copy (the smallest content_hash) is kept
+        raw_row('wola', offer),
+        raw_row('mokotow', offer),
+        #the same content under two urls, the smaller url is kept whichever comes first
+        raw_row('bemowo', 'https://www.otodom.pl/pl/oferta/trzy-pokoje-ID4efgh', 900000),
+        raw_row('bemowo', 'https://www.otodom.pl/hpr/pl/oferta/trzy-pokoje-ID4efgh', 900000),
+        raw_row('ursus', 'https://www.otodom.pl/pl/oferta/kawalerka-ID4ijkl', 600000)
+    ]
+    raw_path = str(tmp_path / 'otodom_scraped_2026-01.csv')
+    write_raw(raw_path, rows)
+
+    clean_streaming([raw_path], str(tmp_path / 'flats_dataset'))
+
+    streamed = (
+        pl.read_parquet(str(tmp_path / 'flats_dataset' / 'month=2026-01' / '**' / '*.parquet'), hive_partitioning=True)
+        .with_columns(col('district').cast(pl.String))
+    )
+    collected = clean(scan_raw_path(raw_path), '2026-01').collect().with_columns(cs.categorical().cast(pl.String))
+
+    assert streamed.height == 3
+    assert streamed['id'].n_unique() == 3
+    assert 'https://www.otodom.pl/hpr/pl/oferta/trzy-pokoje-ID4efgh' in streamed['url'].to_list()
+    #both modes keep the same copies
+    key = ['id', 'content_hash', 'url', 'district']
+    assert streamed.select(key).sort('id').equals(collected.select(key).sort('id'))
+
+
+def test_extras_mask_counts_a_repeated_feature_once():
+    extras = pl.DataFrame({'extras': ['lift, lift', 'lift, balcony, lift', 'sauna, lift']})
+    assert extras.select(extras_mask())['extras_mask'].to_list() == [
+        extra_bits['lift'], extra_bits['lift'] | extra_bits['balcony'], extra_bits['lift']
+    ]
@@ -0,0 +1,37 @@
+from flats_filters import FilterSpec
+
+districts = ['Bemowo', 'Mokotow', 'Wola']
+codes = {'district': {'Bemowo': 1, 'Mokotow': 2, 'Wola': 3}, 'building_ownership': {}, 'construction_status': {}}
+bounds = {
+    'price': (300000, 5000000, 0),
+    'built_year': (1890, 2027, 12),
+    'district': districts,
+    'building_ownership': ['Full Ownership', 'Unknown'],
+    'construction_status': ['Ready To Use', 'To Completion']
+}
+
+
+def dashboard_spec(selected_districts=districts, is_primary=None, price=(300000, 5000000), extras=()):
+    #same arguments as the spec of the dashboard, which selects all districts and the whole ranges by default
+    return FilterSpec(
+        categories={'district': selected_districts, 'building_ownership': [], 'construction_status': []},
+        is_primary=is_primary,
+        ranges={'price': (*price, False), 'built_year': (1890, 2027, True)},
+        extras=extras
+    )
+
+
+def test_default_spec_maps_to_the_all_row():
+    assert dashboard_spec().rollup_row(bounds, codes) == (-1, -1)
+    assert dashboard_spec(is_primary=1).rollup_row(bounds, codes) == (-1, 1)
+
+
+def test_one_district_maps_to_its_row():
+    assert dashboard_spec(['Wola'], is_primary=0).rollup_row(bounds, codes) == (3, 0)
+
+
+def test_filters_the_rollup_cannot_answer():
+    assert dashboard_spec(['Wola', 'Mokotow']).rollup_row(bounds, codes) is None
+    assert dashboard_spec(price=(400000, 5000000)).rollup_row(bounds, codes) is None
+    assert dashboard_spec(extras=['lift']).rollup_row(bounds, codes) is None
+    assert dashboard_spec(['Ursus']).rollup_row(bounds, codes) is None
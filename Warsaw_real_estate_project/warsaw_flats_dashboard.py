@@ -2,10 +2,15 @@ import streamlit as st
 import polars as pl
 from polars import col
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import os
+import math
 import sqlite3
-import pandas as pd
-import re
+from flats_cleaning import extra_bits, extras_flags, extras_names
+from flats_dataset import data_version, scan_flats, current_offers, collect
+from flats_filters import FilterSpec, category_columns
+from warsaw_flats_db_setup import db_path, ReadPool
 
 
 #----------- PAGE SETUP ----------- 
@@ -17,72 +22,30 @@ st.set_page_config(
 
 
 #----------- LOADING DATA  ----------- 
+#read once per version of the data and shared by all sessions (cache_resource keeps one frame instead of a copy per session),
+#version is part of the key, so a new or cleaned again month is read on the next rerun and the old frame is dropped
+@st.cache_resource(max_entries=1, show_spinner='Loading offers...')
+def load_offers(version):
+    #latest version of every offer from all cleaned months (parquet dataset, csv files for months which aren't in it)
+    return collect(current_offers(scan_flats()).drop('month'))
+
+
 def load_data():
     
-    file_pattern = r'^flats_20\d{2}-\d{2}\.csv$'
-    directory = '.' 
-    
-    #all files with the given pattern
-    if not os.path.exists(directory):
-        st.error(f'Directory {directory} not found')
-        st.stop()
-        
-    all_files = os.listdir(directory)
-    matching_files = [f for f in all_files if re.match(file_pattern, f)]
-    matching_files.sort()
-    
-    if not matching_files:
-        st.error(f'No files found matching pattern: {file_pattern}')
-        st.stop()
-        
-    dataframes = []
-    
-    #reading files
-    for filename in matching_files:
-        try:
-            df_temp = pl.read_csv(filename, separator=';', quote_char='"')
-            df_temp.columns = [c.strip() for c in df_temp.columns]
-            
-            dataframes.append(df_temp)
-            
-        except Exception as e:
-            st.warning(f'Error loading file {filename}: {e}. Skipping this file.')
-            
-    if not dataframes:
-        st.error('Failed to load any data files')
+    #names, sizes and modification times of the files, a few stat calls per rerun
+    version = data_version()
+    if not version:
+        st.error('No cleaned data found, run flats_cleaning.py first')
         st.stop()
         
-    #combining files into dataframe
     try:
-        df = pl.concat(dataframes, how="vertical")
-        
-        if 'id' in df.columns:
-            df = df.unique(subset='id', keep='last', maintain_order=True)
-            
-    except Exception as e:
-        st.error(f'Error concatenating files (check if column names/types match): {e}')
-        st.stop()
-        
-    try:
-        # column mapping
-        expected_cols = [
-            'lift', 'balcony', 'garage', 'basement', 'separate_kitchen', 
-            'usable_room', 'air_conditioning', 'terrace', 'garden', 'two_storey',
-            'building_ownership', 'construction_status', 'windows_type', 
-            'no_floor', 'building_floors_num', 'is_primary', 'price_per_sq_m', 'built_year'
-        ]
-        
-        for col in expected_cols:
-            if col not in df.columns and col in expected_cols[:10]: 
-                df = df.with_columns(pl.lit(0).alias(col))
-        
-        return df
-        
+        return version, load_offers(version)
+    
     except Exception as e:
-        st.error(f'Error processing data columns: {e}')
+        st.error(f'Error reading the data (check if column names/types match): {e}')
         st.stop()
 
-flats = load_data()
+data_ver, flats = load_data()
 
 
 #----------- UNIQUE VALUES IN A COLUMN ----------- 
@@ -233,46 +196,244 @@ with st.sidebar:
 
 
 #----------- FILTERING LOGIC -----------
-if not selected_districts: selected_districts = get_unique_list(flats, 'district')
-
-#mask
-mask = (
-    (col('district').is_in(selected_districts)) &
-    (col('price').is_between(min_price, max_price)) &
-    (col('area').is_between(min_area, max_area)) &
-    (col('price_per_sq_m').is_between(min_price_per_sqm, max_price_per_sqm))&
-    (
-        (col('built_year').is_between(min_year, max_year)) | 
-        (col('built_year').is_null()) #handling null years
-    )
-)
-#apply primary/secondary filter
-if market_origin_opt == 'Primary Market':
-    mask = mask & (col('is_primary') == 1)
-elif market_origin_opt == 'Secondary Market':
-    mask = mask & (col('is_primary') == 0)
-
-df_filtered = flats.filter(mask)
-
-#filtering extras
-for extra in selected_extras:
-    if extra in df_filtered.columns:
-        df_filtered = df_filtered.filter(col(extra) == 1)
-
-#apply categories
-if sel_ownership:
-    df_filtered = df_filtered.filter(col('building_ownership').is_in(sel_ownership))
-if sel_status:
-    df_filtered = df_filtered.filter(col('construction_status').is_in(sel_status))
-
-#apply floors
-df_filtered = df_filtered.filter(
-    ((col('no_floor') >= min_floor) & (col('no_floor') <= max_floor)) |
-    (col('no_floor').is_null())  #including null values
+#filtered offers of one filter state, shared by all sessions, so going back to an earlier state doesn't filter again
+@st.cache_resource(max_entries=16, hash_funcs={FilterSpec: FilterSpec.key})
+def filter_offers(version, spec):
+    return load_offers(version).filter(spec.to_expr())
+
+
+#one specification of all filters, compiled to polars for the charts and to sql for top deals
+market_map = {'All': None, 'Primary Market': 1, 'Secondary Market': 0}
+spec = FilterSpec(
+    categories={
+        'district': selected_districts,
+        'building_ownership': sel_ownership,
+        'construction_status': sel_status
+    },
+    is_primary=market_map[market_origin_opt],
+    ranges={
+        'price': (min_price, max_price, False),
+        'area': (min_area, max_area, False),
+        'price_per_sq_m': (min_price_per_sqm, max_price_per_sqm, False),
+        'built_year': (min_year, max_year, True), #handling null years
+        'no_floor': (min_floor, max_floor, True) #including null floors
+    },
+    extras=selected_extras
 )
+df_filtered = filter_offers(data_ver, spec)
+
+
+#----------- DATABASE -----------
+#read-only connections shared by all sessions, opened again when the db file is replaced
+@st.cache_resource
+def get_pool():
+    return ReadPool(db_path)
+
+
+def db_version():
+    '''Sizes and modification times of the db and its wal file, they change with every load'''
+    return tuple((p, os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in (db_path, db_path + '-wal') if os.path.exists(p))
+
+
+#categories are stored as integer codes of the dim_{column} tables, read once per version of the db
+@st.cache_data(max_entries=1)
+def load_codes(version):
+    with get_pool().connection() as conn:
+        return {c: dict(conn.execute(f'SELECT name, id FROM dim_{c}').fetchall()) for c in category_columns}
+
+
+#----------- SUMMARY STATISTICS -----------
+#only the numbers the charts show are computed in polars and sent to plotly, not the rows behind them
+
+@st.cache_data(max_entries=32, hash_funcs={FilterSpec: FilterSpec.key})
+def offer_stats(version, spec):
+    '''Number of offers, medians of the kpis and the colour range of the map'''
+    return filter_offers(version, spec).select(
+        pl.len().alias('offers'),
+        col('price').median().alias('median_price'),
+        col('price_per_sq_m').median().alias('median_sqm'),
+        col('area').median().alias('median_area'),
+        col('price_per_sq_m').quantile(0.01, 'linear').alias('min_color'),
+        col('price_per_sq_m').quantile(0.95, 'linear').alias('max_color')
+    ).row(0, named=True)
+
+
+@st.cache_data(max_entries=64, hash_funcs={FilterSpec: FilterSpec.key})
+def distribution(version, spec, column, nbins=50):
+    '''Counts of nbins equal bins and the box plot statistics (quartiles, whiskers at 1.5 IQR) of one column'''
+    values = filter_offers(version, spec).get_column(column).drop_nulls()
+    #integer columns (years, rooms, floors) get bins of whole numbers centered on the values
+    whole_numbers = values.dtype.is_integer()
+    values = values.cast(pl.Float64)
+    if values.is_empty():
+        return None
+    low, high = values.min(), values.max()
+
+    if whole_numbers:
+        width = max(1, math.ceil((high - low + 1) / nbins))
+        start = low - 0.5
+    else:
+        width = (high - low) / nbins or 1
+        start = low
+    bins = (
+        ((values - start) / width).floor().clip(0, nbins - 1).value_counts(name='offers')
+        .rename({column: 'bin'})
+        .sort('bin')
+        .with_columns((start + (col('bin') + 0.5) * width).alias('center'))
+    )
+
+    q1, median, q3 = (values.quantile(q, 'linear') for q in (0.25, 0.5, 0.75))
+    iqr = q3 - q1
+    box = {
+        'q1': q1,
+        'median': median,
+        'q3': q3,
+        #whiskers end at the furthest values within 1.5 IQR of the box
+        'lowerfence': values.filter(values >= q1 - 1.5 * iqr).min(),
+        'upperfence': values.filter(values <= q3 + 1.5 * iqr).max()
+    }
+    return bins, width, box
+
+
+@st.cache_data(max_entries=32, hash_funcs={FilterSpec: FilterSpec.key})
+def correlation(version, spec, columns):
+    '''Pearson correlation of every pair of columns, each pair over the rows where both values are present'''
+    flats = filter_offers(version, spec).with_columns(extras_flags([c for c in columns if c in extra_bits])).select(columns)
+    #one pass for the upper triangle, the matrix is symmetric
+    pairs = [(i, j) for i in range(len(columns)) for j in range(i, len(columns))]
+    values = flats.select([pl.corr(columns[i], columns[j]).alias(f'{i}_{j}') for i, j in pairs]).row(0)
+    matrix = [[None] * len(columns) for _ in columns]
+    for (i, j), value in zip(pairs, values):
+        value = None if value is None or math.isnan(value) else round(value, 2)
+        matrix[i][j] = matrix[j][i] = value
+    return matrix
+
+
+@st.cache_data(max_entries=32, hash_funcs={FilterSpec: FilterSpec.key})
+def district_medians(version, spec):
+    return (
+        filter_offers(version, spec)
+        .group_by('district')
+        .agg(col('price_per_sq_m').median())
+        .sort('price_per_sq_m')
+    )
+
+
+#----------- ROLLUP -----------
+#when the filters cut only by one district (or select all of them) and the market, the summaries are read
+#from the rollup table of the db (a row per district and market) instead of the offers
+
+#columns with a range filter
+range_columns = ['price', 'area', 'price_per_sq_m', 'built_year', 'no_floor']
+
 
-#pandas for plotly 
-df_pd = df_filtered.to_pandas()
+@st.cache_data(max_entries=1)
+def column_bounds(version):
+    '''Lowest and highest value and number of nulls of every range column and all names of every category column,
+    a range covering them or a selection of all names leaves out nothing'''
+    flats = load_offers(version)
+    row = flats.select(
+        [col(c).min().alias(f'{c}_min') for c in range_columns] +
+        [col(c).max().alias(f'{c}_max') for c in range_columns] +
+        [col(c).null_count().alias(f'{c}_nulls') for c in range_columns]
+    ).row(0, named=True)
+    bounds = {c: (row[f'{c}_min'], row[f'{c}_max'], row[f'{c}_nulls']) for c in range_columns}
+    bounds.update({c: get_unique_list(flats, c) for c in category_columns})
+    return bounds
+
+
+@st.cache_data(max_entries=1)
+def rollup_sources(version):
+    '''Files the rollup was built from (same form as data_version), None when the db has no rollup yet'''
+    try:
+        with get_pool().connection() as conn:
+            return tuple(sorted(conn.execute('SELECT path, size, mtime_ns FROM rollup_sources').fetchall()))
+    except sqlite3.Error:
+        return None
+
+
+@st.cache_data(max_entries=32)
+def rollup_summary(version, district, market):
+    '''Same numbers as offer_stats and district_medians, read from the rollup rows of all months,
+    district and market are codes, -1 for all of them'''
+    with get_pool().connection() as conn:
+        cursor = conn.execute("""
+            SELECT district_id, (SELECT name FROM dim_district WHERE id = district_id) AS district, offers,
+                median_price, median_price_per_sq_m, median_area, p01_price_per_sq_m, p95_price_per_sq_m
+            FROM flats_rollup
+            WHERE month = 'all' AND is_primary = ?
+                AND (district_id = ? OR (district_id != -1 AND ? IN (-1, district_id)))
+        """, (market, district, district))
+        rows = pl.DataFrame(cursor.fetchall(), schema=[d[0] for d in cursor.description], orient='row')
+
+    kpis = rows.filter(col('district_id') == district)
+    if kpis.is_empty():
+        stats = {'offers': 0, 'median_price': None, 'median_sqm': None, 'median_area': None, 'min_color': None, 'max_color': None}
+    else:
+        row = kpis.row(0, named=True)
+        stats = {
+            'offers': row['offers'],
+            'median_price': row['median_price'],
+            'median_sqm': row['median_price_per_sq_m'],
+            'median_area': row['median_area'],
+            'min_color': row['p01_price_per_sq_m'],
+            'max_color': row['p95_price_per_sq_m']
+        }
+    districts = (
+        rows.filter(col('district_id') != -1)
+        .select('district', col('median_price_per_sq_m').alias('price_per_sq_m'))
+        .cast({'district': pl.String, 'price_per_sq_m': pl.Float64})
+        .sort('price_per_sq_m')
+    )
+    return stats, districts
+
+
+def summary(version, spec):
+    '''Kpis and district medians, from the rollup when it can answer the filters and was built from the same files as the data'''
+    db_ver = db_version()
+    if db_ver and rollup_sources(db_ver) == tuple(sorted(version)):
+        #the db can be replaced or lose its tables while it's read, the summaries are then computed from the offers
+        try:
+            row = spec.rollup_row(column_bounds(version), load_codes(db_ver))
+            if row is not None:
+                return rollup_summary(db_ver, *row)
+        except sqlite3.Error:
+            pass
+    return offer_stats(version, spec), district_medians(version, spec)
+
+
+#----------- MAP CELLS -----------
+#filtered offers are drawn as single points up to this number, above it as cells of a grid,
+#so the map sends at most one marker per cell to the browser however many offers there are
+map_point_limit = 5000
+cell_sizes = {'250 m': 250, '500 m': 500, '1 km': 1000, '2 km': 2000}
+
+
+@st.cache_data(max_entries=32, hash_funcs={FilterSpec: FilterSpec.key})
+def map_cells(version, spec, cell_m):
+    '''Filtered offers grouped into square cells of cell_m metres, number of offers and medians per cell'''
+    #degrees per metre, a degree of longitude is shorter at the latitude of Warsaw
+    lat_step = cell_m / 111_320
+    long_step = cell_m / (111_320 * math.cos(math.radians(52.23)))
+    return (
+        filter_offers(version, spec)
+        .drop_nulls(['lat', 'long'])
+        .group_by(
+            (col('lat') / lat_step).floor().alias('cell_lat'),
+            (col('long') / long_step).floor().alias('cell_long')
+        )
+        .agg(
+            pl.len().alias('offers'),
+            col('price').median(),
+            col('price_per_sq_m').median()
+        )
+        #markers in the middle of the cells
+        .with_columns(
+            ((col('cell_lat') + 0.5) * lat_step).alias('lat'),
+            ((col('cell_long') + 0.5) * long_step).alias('long')
+        )
+        .drop('cell_lat', 'cell_long')
+    )
 
 
 #----------- DASHBOARD -----------
@@ -281,13 +442,15 @@ st.title('Warsaw Real Estate Overview')
 
 #----------- KPIS -----------
 kpi1, kpi2, kpi3, kpi4 = st.columns(4)
-median = df_pd['price'].median() if not df_pd.empty else 0
-median_sqm = df_pd['price_per_sq_m'].median() if not df_pd.empty else 0
-median_area = df_pd['area'].median() if not df_pd.empty else 0
+stats, district_stats = summary(data_ver, spec)
+n_offers = stats['offers']
+median = stats['median_price'] or 0
+median_sqm = stats['median_sqm'] or 0
+median_area = stats['median_area'] or 0
 
 
 
-kpi1.metric('Total Offers', f'{len(df_pd):,}'.replace(',', ' '))
+kpi1.metric('Total Offers', f'{n_offers:,}'.replace(',', ' '))
 kpi2.metric('Median Price', f'{median:,.0f}'.replace(',', ' ') + ' PLN')
 kpi3.metric('Median Price/m²', f'{median_sqm:,.0f}'.replace(',', ' ') + ' PLN')
 kpi4.metric('Median Area in m²', f'{median_area:,.0f}'.replace(',', ' '))
@@ -300,15 +463,17 @@ c_map, c_distplot = st.columns([2, 2])
 with c_map:
     
     #setting up colors, otherwise the scale wouldn't show difference well enough 
-    min_color = df_pd['price_per_sq_m'].quantile(0.01)
-    max_color = df_pd['price_per_sq_m'].quantile(0.95)
+    min_color = stats['min_color']
+    max_color = stats['max_color']
     
     
     
     st.subheader('Offer Map')
-    if not df_pd.empty:
+    if n_offers and n_offers <= map_point_limit:
+        #only the columns of the map
+        df_map = df_filtered.select('lat', 'long', 'price_per_sq_m', 'area', 'district', 'price', 'built_year').to_pandas()
         fig_map = px.scatter_mapbox(
-            df_pd, 
+            df_map, 
             lat='lat', 
             lon='long', 
             color='price_per_sq_m', 
@@ -331,6 +496,33 @@ with c_map:
         fig_map.update_layout(mapbox_style='carto-darkmatter', margin={'r':0,'t':0,'l':0,'b':0})
         st.plotly_chart(fig_map, width='stretch')
 
+    elif n_offers:
+        #too many offers for single points, cells of the chosen size instead
+        cell_label = st.select_slider('Cell size', list(cell_sizes.keys()), value='500 m')
+        df_cells = map_cells(data_ver, spec, cell_sizes[cell_label]).to_pandas()
+        fig_map = px.scatter_mapbox(
+            df_cells, 
+            lat='lat', 
+            lon='long', 
+            color='price_per_sq_m', 
+            size='offers',
+            color_continuous_scale='RdYlGn_r', 
+            range_color=[min_color, max_color],
+            zoom=9.5, 
+            height=500,
+            custom_data=['offers', 'price', 'price_per_sq_m'],
+            labels={'price_per_sq_m': 'Median Price/m²'}
+        )
+        fig_map.update_traces(hovertemplate=(
+            "<b>Offers</b>: %{customdata[0]}<br>"
+            "<b>Median Price</b>: %{customdata[1]:,.0f} PLN<br>"
+            "<b>Median Price/m²</b>: %{customdata[2]:,.0f} PLN"
+            "<extra></extra>"
+        ))
+        fig_map.update_layout(mapbox_style='carto-darkmatter', margin={'r':0,'t':0,'l':0,'b':0})
+        st.plotly_chart(fig_map, width='stretch')
+        st.caption(f'{n_offers:,} offers in {len(df_cells):,} cells (points are shown up to {map_point_limit:,} offers)'.replace(',', ' '))
+
 
 with c_distplot:
     #dictionary for picklist
@@ -355,22 +547,37 @@ with c_distplot:
 
 
     st.subheader(f'Distribution of {lbl}')
-    if not df_pd.empty:
-        fig_dist = px.histogram(
-            df_pd, 
-            x=selected_col_name, 
-            nbins=50, 
-            marginal='box', 
-            color_discrete_sequence=['#1E6583']
+    dist = distribution(data_ver, spec, selected_col_name)
+    if dist is not None:
+        bins, width, box = dist
+        
+        #box above the histogram, like marginal='box' but drawn from the statistics
+        fig_dist = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.2, 0.8], vertical_spacing=0.02)
+        fig_dist.add_trace(
+            go.Box(
+                name=lbl,
+                orientation='h',
+                boxpoints=False,
+                marker_color='#1E6583',
+                hoverinfo='x',
+                **{k: [v] for k, v in box.items()}
+            ),
+            row=1, col=1
         )
+        fig_dist.add_trace(
+            go.Bar(x=bins['center'].to_list(), y=bins['offers'].to_list(), width=width, marker_color='#1E6583'),
+            row=2, col=1
+        )
+        fig_dist.update_yaxes(showticklabels=False, row=1, col=1)
         
        #formatting hover
-        fig_dist.update_traces(hovertemplate="<b>" + lbl + "</b>: %{x}<br><b>Number of occurrences</b>: %{y}<extra></extra>")
+        fig_dist.update_traces(hovertemplate="<b>" + lbl + "</b>: %{x}<br><b>Number of occurrences</b>: %{y}<extra></extra>", selector={'type': 'bar'})
 
 
         fig_dist.update_layout(
-            xaxis_title=lbl, 
-            yaxis_title='Number of offers',
+            xaxis2_title=lbl, 
+            yaxis2_title='Number of offers',
+
             showlegend=False,
             margin={'r':0,'t':40,'l':0,'b':0}
         )
@@ -401,15 +608,15 @@ with c_corel:
 
     }
 
-    #checking if passed columns are in df
-    available_cols = [c for c in corr_labels.keys() if c in df_pd.columns]
+    #checking if passed columns are in df, extras are taken out of extras_mask
+    available_cols = [c for c in corr_labels.keys() if c in df_filtered.columns or c in extra_bits]
 
     if available_cols:
         #evaluating correlation 
-        corr_matrix = df_pd[available_cols].corr().round(2)
+        corr_matrix = correlation(data_ver, spec, available_cols)
 
         #setting up labels
-        corr_lbl = [corr_labels[col] for col in corr_matrix.columns]
+        corr_lbl = [corr_labels[col] for col in available_cols]
 
         #create plot
         fig_corr = px.imshow(
@@ -433,8 +640,7 @@ with c_top_districts:
     st.subheader('Districts by median Price/m²')
 
     #getting median for districts
-    district_stats = df_pd.groupby('district')['price_per_sq_m'].median().reset_index()
-    district_stats = district_stats.sort_values('price_per_sq_m', ascending=True)
+    district_stats = district_stats.to_pandas()
 
     #create plot
     fig_ranking = px.bar(
@@ -460,8 +666,24 @@ st.divider()
 # --- TOP DEALS SECTION SQL ---
 st.header('Top Deals')
 
-#connecting to the db
-conn = sqlite3.connect('warsaw_flats.db')
+#district name looked up per returned row, so the rows are still read from the covering indexes
+cols_sql = "(SELECT name FROM dim_district WHERE id = flats.district_id) AS district, price, price_per_sq_m, area, no_rooms, no_floor, url"
+
+#lowest and highest rows in one query, cached per filter state, sort and limit, the filter values are bound as parameters
+#so the sql text only changes with the shape of the filters and its prepared statement is reused
+@st.cache_data(max_entries=64)
+def top_deals(version, where_clause, params, sort_col, n):
+    query = f"""
+        SELECT * FROM (SELECT 0 AS high, {cols_sql} FROM flats {where_clause} ORDER BY {sort_col} ASC LIMIT ?)
+        UNION ALL
+        SELECT * FROM (SELECT 1 AS high, {cols_sql} FROM flats {where_clause} ORDER BY {sort_col} DESC LIMIT ?)
+    """
+    with get_pool().connection() as conn:
+        cursor = conn.execute(query, params + (n,) + params + (n,))
+        #rows go straight into polars, without pandas
+        deals = pl.DataFrame(cursor.fetchall(), schema=[d[0] for d in cursor.description], orient='row')
+    return deals.filter(col('high') == 0).drop('high'), deals.filter(col('high') == 1).drop('high')
+
 
 #setting up columns
 c_ctrl1, c_ctrl2 = st.columns([1, 2])
@@ -477,49 +699,8 @@ with c_ctrl2:
     sort_col_tech = sort_col_map[sort_selection]
 
 
-#creating conditions for filtering the data via SQL
-conditions = []
-
-#districts
-if selected_districts:
-    safe_districts = "', '".join(selected_districts)
-    conditions.append(f"district IN ('{safe_districts}')")
-
-#market type
-if market_origin_opt == 'Primary Market':
-    conditions.append("is_primary = 1")
-elif market_origin_opt == 'Secondary Market':
-    conditions.append("is_primary = 0")
-
-#price
-if 'min_price' in locals():
-    conditions.append(f"price BETWEEN {min_price} AND {max_price}")
-#area
-if 'min_area' in locals():
-    conditions.append(f"area BETWEEN {min_area} AND {max_area}")
-#price per sqm
-if 'min_price_per_sqm' in locals():
-    conditions.append(f"price_per_sq_m BETWEEN {min_price_per_sqm} AND {max_price_per_sqm}")
-#year
-if 'min_year' in locals():
-    conditions.append(f"(built_year BETWEEN {min_year} AND {max_year} OR built_year IS NULL)")
-#floor
-if 'min_floor' in locals():
-    conditions.append(f"(no_floor BETWEEN {min_floor} AND {max_floor} OR no_floor IS NULL)")
-#ownership
-if sel_ownership:
-    formatted_own = "', '".join(sel_ownership)
-    conditions.append(f"building_ownership IN ('{formatted_own}')")
-if sel_status:
-    formatted_status = "', '".join(sel_status)
-    conditions.append(f"construction_status IN ('{formatted_status}')")
-
-#extras
-for extra in selected_extras:
-    conditions.append(f"{extra} = 1")
-
-#combining conditions into where clause
-where_clause = "WHERE " + " AND ".join(conditions) if conditions else ""
+#same filters as the charts, compiled to sql with the codes of the db below
+db_ver = db_version()
 
 
 #setting up columns to display
@@ -532,70 +713,67 @@ col_config = {
     'area': st.column_config.NumberColumn('Area', format='%.2f m²'),
     'url': st.column_config.LinkColumn('Offer Link'),
 }
-cols_sql = "district, price, price_per_sq_m, area, no_rooms, no_floor, url"
 
 #table layout
 col_low, col_high = st.columns(2)
 
+try:
+    where_clause, params = spec.to_sql(load_codes(db_ver))
+    df_low, df_high = top_deals(db_ver, where_clause, params, sort_col_tech, top_n)
+except Exception as e:
+    st.error(f'SQL error {e}')
+    df_low = df_high = pl.DataFrame()
+
 with col_low:
     st.subheader(f' Lowest {sort_selection}')
     
     
-    query_low = f"""
-        SELECT {cols_sql}
-        FROM flats
-        {where_clause}
-        ORDER BY {sort_col_tech} ASC
-        LIMIT {top_n}
-    """
-    
-    try:
-        df_low = pd.read_sql(query_low, conn)
-        if not df_low.empty:
-            st.dataframe(
-                df_low,
-                hide_index=True,
-                column_config=col_config,
-                width='stretch'
-            )
-        else:
-            st.info('No results for selected filters')
-    except Exception as e:
-        st.error(f'SQL error {e}')
+    if not df_low.is_empty():
+        st.dataframe(
+            df_low,
+            hide_index=True,
+            column_config=col_config,
+            width='stretch'
+        )
+    else:
+        st.info('No results for selected filters')
 
 with col_high:
     st.subheader(f' Highest {sort_selection}')
     
 
-    query_high = f"""
-        SELECT {cols_sql}
-        FROM flats
-        {where_clause}
-        ORDER BY {sort_col_tech} DESC
-        LIMIT {top_n}
-    """
-    
-    try:
-        df_high = pd.read_sql(query_high, conn)
-        if not df_high.empty:
-            st.dataframe(
-                df_high,
-                hide_index=True,
-                column_config=col_config,
-                width='stretch'
-            )
-        else:
-            st.info('No results for selected filters')
-    except Exception as e:
-        st.error(f'SQL error {e}')
-
-#closing connection
-conn.close()
+    if not df_high.is_empty():
+        st.dataframe(
+            df_high,
+            hide_index=True,
+            column_config=col_config,
+            width='stretch'
+        )
+    else:
+        st.info('No results for selected filters')
 
-#all data table
+#all data table, one page of rows at a time, without the columns used only for loading and filtering (content_hash, extras_mask)
 st.subheader('Collected data')
+page_size = 100
+data_columns = [
+    'id', 'price', 'rent', 'area', 'price_per_sq_m', 'no_rooms', 'building_type', 'no_floor', 'building_floors_num',
+    'windows_type', 'construction_status', 'building_ownership', 'lat', 'long', 'district', 'built_year', 'url',
+    'rent_per_sq_m', 'extras', 'is_primary', 'date_scraped'
+]
+n_pages = max(1, math.ceil(n_offers / page_size))
+
+#page from an earlier filter state can be past the last page now
+if st.session_state.get('data_page', 1) > n_pages:
+    st.session_state['data_page'] = n_pages
+c_page, c_rows = st.columns([1, 3])
+with c_page:
+    page = st.number_input('Page', min_value=1, max_value=n_pages, step=1, key='data_page')
+with c_rows:
+    first_row = (page - 1) * page_size
+    st.caption(f'Offers {min(first_row + 1, n_offers):,}-{min(first_row + page_size, n_offers):,} of {n_offers:,}'.replace(',', ' '))
+
 st.dataframe(
-    df_pd,
+    df_filtered.slice(first_row, page_size).with_columns(extras_names()).select(data_columns),
     width='stretch',
     column_config={'url': st.column_config.LinkColumn('Link')},
     hide_index=True
@@ -1,45 +1,75 @@
-import pandas as pd
 import sqlite3
 import os
-import re
-import numpy as np
+import queue
+from contextlib import contextmanager
+import polars as pl
+from polars import col
+from flats_cleaning import extra_bits, offer_id
+from flats_dataset import month_sources, month_batches, data_version
 
 db_path = 'warsaw_flats.db'
-file_pattern = r'^flats_20\d{2}-\d{2}\.csv$'
+#offers seen again by the scraper in incremental mode, not downloaded and so not in the flats file of the month
+active_file = 'otodom_active_{month}.csv'
+
+#version of the table layout kept in PRAGMA user_version
+#1 = ids from the otodom offer id + content_hash, 2 = extras packed into extras_mask, 3 = categories in dimension tables,
+#4 = monthly versions of every offer in flats_history
+schema_version = 4
+
+#categorical columns stored as integer codes ({column}_id) of the rows in dim_{column}
+dimension_columns = ['building_type', 'windows_type', 'construction_status', 'building_ownership', 'district']
+
+#rows sent to sqlite at once, memory of the load depends on this and not on the size of the files
+batch_size = 50_000
+
+#----------- INDEXES FOR THE DASHBOARD QUERIES -----------
+#top deals select these columns, filter on the rest and sort by price, price_per_sq_m or area with a LIMIT
+top_deals_columns = ['district_id', 'price', 'price_per_sq_m', 'area', 'no_rooms', 'no_floor', 'url']
+top_deals_filters = ['is_primary', 'built_year', 'building_ownership_id', 'construction_status_id', 'extras_mask']
+
+#one covering index per sort column: rows are read already sorted, filters are checked in the index
+#and the scan stops after LIMIT matches, without a sort or a lookup in the table
+indexes = {
+    f'idx_flats_top_{sort_col}': [sort_col] + [c for c in top_deals_columns + top_deals_filters if c != sort_col]
+    for sort_col in ['price', 'price_per_sq_m', 'area']
+}
+#narrow selections (a single district or market) are found through this index instead
+indexes['idx_flats_district'] = ['district_id', 'is_primary', 'price_per_sq_m']
+
+#----------- ROLLUP FOR THE DASHBOARD SUMMARIES -----------
+#offers summed up by these columns, month = 'all' is the latest version of every offer (the offers of the dashboard),
+#a loaded month is the versions listed in it (from flats_history), district and market are also summed up over all values (rollup_all),
+#e.g. month = 'all', district_id = -1 is all offers of a market type
+rollup_columns = ['month', 'district_id', 'is_primary']
+rollup_all = {'district_id': -1, 'is_primary': -1}
+#columns with sums and exact medians in the rollup, price_per_sq_m also has the 1% and 95% quantiles (colour range of the map)
+rollup_measures = ['price', 'area', 'price_per_sq_m']
 
 
 #----------- DATATYPE MAPPING -----------
 dtype_map = {
-    'id': 'Int64', 
-    'price': 'float64',
-    'rent': 'float64',
-    'area': 'float64',
-    'price_per_sq_m': 'float64',
-    'no_rooms': 'Int64',
-    'building_type': 'category',
-    'no_floor': 'Int64',
-    'building_floors_num': 'Int64',
-    'windows_type': 'category',
-    'construction_status': 'category',
-    'building_ownership': 'category',
-    'lat': 'float64',
-    'long': 'float64',
-    'district': 'category',
-    'built_year' :'Int64',
-    'url': 'string',
-    'rent_per_sq_m': 'float64',
-    'lift': 'Int8',
-    'balcony': 'Int8',
-    'garage': 'Int8',
-    'basement': 'Int8',
-    'separate_kitchen': 'Int8',
-    'usable_room': 'Int8',
-    'air_conditioning': 'Int8',
-    'terrace': 'Int8',
-    'garden': 'Int8',
-    'two_storey': 'Int8',
-    'is_primary': 'Int8',
-    'date_scraped': 'string' 
+    'id': pl.Int64,
+    'content_hash': pl.Int64,
+    'price': pl.Float64,
+    'rent': pl.Float64,
+    'area': pl.Float64,
+    'price_per_sq_m': pl.Float64,
+    'no_rooms': pl.Int64,
+    'building_type': pl.String,
+    'no_floor': pl.Int64,
+    'building_floors_num': pl.Int64,
+    'windows_type': pl.String,
+    'construction_status': pl.String,
+    'building_ownership': pl.String,
+    'lat': pl.Float64,
+    'long': pl.Float64,
+    'district': pl.String,
+    'built_year': pl.Int64,
+    'url': pl.String,
+    'rent_per_sq_m': pl.Float64,
+    'extras_mask': pl.Int16,
+    'is_primary': pl.Int8,
+    'date_scraped': pl.String
 }
 
 
@@ -48,118 +78,436 @@ def create_table_if_not_exists(conn):
     flats_table = """
     CREATE TABLE IF NOT EXISTS flats (
         id INTEGER PRIMARY KEY,
+        content_hash INTEGER,
         price REAL,
         rent REAL,
         area REAL,
         price_per_sq_m REAL,
         no_rooms INTEGER,
-        building_type TEXT,
+        building_type_id INTEGER REFERENCES dim_building_type (id),
         no_floor INTEGER,
         building_floors_num INTEGER,
-        windows_type TEXT,
-        construction_status TEXT,
-        building_ownership TEXT,
+        windows_type_id INTEGER REFERENCES dim_windows_type (id),
+        construction_status_id INTEGER REFERENCES dim_construction_status (id),
+        building_ownership_id INTEGER REFERENCES dim_building_ownership (id),
         lat REAL,
         long REAL,
-        district TEXT,
+        district_id INTEGER REFERENCES dim_district (id),
         built_year INTEGER,
         url TEXT,
         rent_per_sq_m REAL,
-        lift INTEGER,
-        balcony INTEGER,
-        garage INTEGER,
-        basement INTEGER,
-        separate_kitchen INTEGER,
-        usable_room INTEGER,
-        air_conditioning INTEGER,
-        terrace INTEGER,
-        garden INTEGER,
-        two_storey INTEGER,
+        extras_mask INTEGER,
         is_primary INTEGER,
         date_scraped DATE
     );
     """
+    #one small table per category, a text value is stored once and flats keep its code
+    dimension_tables = [
+        f'CREATE TABLE IF NOT EXISTS dim_{c} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);'
+        for c in dimension_columns
+    ]
+
+    #the wide shape of the csv files with the names of the categories and one 0/1 column per extra, derived from the mask
+    wide_cols = [f'dim_{c}.name AS {c}' if c in dimension_columns else f'flats.{c}' for c in dtype_map]
+    flags = [f'(flats.extras_mask & {bit}) != 0 AS {f}' for f, bit in extra_bits.items()]
+    joins = [f'LEFT JOIN dim_{c} ON dim_{c}.id = flats.{c}_id' for c in dimension_columns]
+    flats_wide_view = f"""
+    CREATE VIEW IF NOT EXISTS flats_wide AS
+    SELECT
+        {', '.join(wide_cols + flags)}
+    FROM flats
+    {' '.join(joins)};
+    """
+    #one row per version of an offer: valid from the month it appeared with this content till the month it changed
+    #or disappeared (valid_to is that month, NULL while the version is current), clustered by offer so its history is one range
+    history_table = """
+    CREATE TABLE IF NOT EXISTS flats_history (
+        id INTEGER NOT NULL,
+        valid_from DATE NOT NULL,
+        valid_to DATE,
+        content_hash INTEGER,
+        price REAL,
+        rent REAL,
+        area REAL,
+        price_per_sq_m REAL,
+        PRIMARY KEY (id, valid_from)
+    ) WITHOUT ROWID;
+    """
+    #offers listed in a month: versions valid in it are found by range on valid_from and checked in the index
+    history_index = 'CREATE INDEX IF NOT EXISTS idx_history_valid ON flats_history (valid_from, valid_to)'
+
+    #months already applied to the history, a month is applied once and in order
+    months_table = 'CREATE TABLE IF NOT EXISTS loaded_months (month DATE PRIMARY KEY, offers INTEGER)'
+
+    #every change of price of an offer with the price before it
+    price_changes_view = """
+    CREATE VIEW IF NOT EXISTS flats_price_changes AS
+    SELECT *
+    FROM (
+        SELECT
+            id,
+            valid_from AS changed_in,
+            LAG(price) OVER (PARTITION BY id ORDER BY valid_from) AS previous_price,
+            price
+        FROM flats_history
+    )
+    WHERE previous_price IS NOT price AND previous_price IS NOT NULL;
+    """
     cursor = conn.cursor()
+    for dimension_table in dimension_tables:
+        cursor.execute(dimension_table)
     cursor.execute(flats_table)
+    cursor.execute(flats_wide_view)
+    cursor.execute(history_table)
+    cursor.execute(history_index)
+    cursor.execute(months_table)
+    cursor.execute(price_changes_view)
     conn.commit()
 
 
-#----------- CHECKING FOR ALL FILES IN THE DIRECTORY -----------
-all_files = os.listdir('.')
-csv_files = [f for f in all_files if re.match(file_pattern, f)]
-csv_files.sort()
+#----------- CONNECTION SETTINGS FOR BULK LOADS -----------
+def connect(path=db_path):
+    conn = sqlite3.connect(path)
+    #wal lets the dashboard read while a load is running, synchronous=NORMAL is safe with wal and syncs only at checkpoints
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    #64 MB page cache, a bigger staging table spills to a temporary file instead of growing in memory
+    conn.execute('PRAGMA cache_size = -65536')
+    return conn
 
-#connecting to the db
-conn = sqlite3.connect(db_path)
 
+def connect_read_only(path=db_path):
+    '''Read-only connection for the dashboard, usable from the thread of any session'''
+    #statements are prepared once per connection and reused while the sql text is the same
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False, cached_statements=256)
 
-#-----------  IF TABLE DOESN'T EXIST WE CREATE ONE -----------
-create_table_if_not_exists(conn)
 
+class ReadPool:
+    '''A few read-only connections shared by all sessions of the dashboard, each used by one query at a time'''
+    def __init__(self, path=db_path, size=4):
+        self.path = path
+        #connections are opened on first use, last returned one is taken first, its page and statement caches are the warmest
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put((None, None))
 
-#getting the already existing ids
-try:
-    existing_ids = pd.read_sql('SELECT id FROM flats', conn)
-    existing_ids_set = set(existing_ids['id'].tolist())
-    print(f'There are {len(existing_ids_set)} offers in db.')
-except Exception as e:
-    existing_ids_set = set()
-    print(f'Starting with empty set or error: {e}')
-    
-    
-#-----------  LOADING FILE -----------
-for filename in csv_files:
-    print(f'Loading file {filename}')
+    def file_identity(self):
+        #device and inode of the db file, a file deleted and created again (to load all months again) gets new ones
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_dev, stat.st_ino)
 
-    try:
-        df = pd.read_csv(
-            filename, 
-            sep=';', 
-            quotechar='"', 
-            dtype=dtype_map
-        )
-    except Exception as e:
-        print(f'Error reading {filename}: {e}')
-        continue
-
-    if 'id' not in df.columns:
-        print(f'No id column in {filename}')
-        continue
-
-    #filtering duplicates
-    df_new = df[~df['id'].isin(existing_ids_set)].copy()
-    
-    if not df_new.empty:
-        #-----------  INSERTING DATA -----------
-        
-        #changing nan to None so  SQLite won't raise an error
-        df_new = df_new.replace({np.nan: None})
-        
-        #dynamic insert
-        columns = list(df_new.columns)
-        placeholders = ', '.join(['?'] * len(columns))
-        columns_str = ', '.join(columns)
-        sql_insert = f"INSERT INTO flats ({columns_str}) VALUES ({placeholders})"
-        
-        #converting data to list so it can be loaded
-        data_to_insert = df_new.values.tolist()
-        
-        cursor = conn.cursor()
+    @contextmanager
+    def connection(self):
+        identity, conn = self.idle.get()
         try:
-            cursor.executemany(sql_insert, data_to_insert)
-            conn.commit()
-            
-            #updating ids
-            new_ids = df_new['id'].tolist()
-            existing_ids_set.update(new_ids)
-            
-            print(f'Added {len(df_new)} unique offers.')
-            
-        except sqlite3.Error as e:
-            print(f'Error inserting data from {filename}: {e}')
-            
+            #a connection to a replaced file would keep reading the deleted one (and keep it from being deleted on windows)
+            current = self.file_identity()
+            if conn is not None and identity != current:
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = connect_read_only(self.path)
+                identity = current
+            yield conn
+        finally:
+            self.idle.put((identity, conn))
+
+
+#-----------  TABLE WITH OLD IDS IS BUILT AGAIN -----------
+def migrate(conn):
+    '''Dropping a table with an older layout, returns True when the db has to be loaded again from the files'''
+    #older layouts (hashes of whole rows as ids, one column per extra, text categories) can't be matched with the new rows
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= schema_version:
+        return False
+    #a new db (no flats table yet) and a db with the current layout whose version wasn't set are kept,
+    #a flats table without flats_history (layout 3) is loaded again too, so the history gets every month
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    flats_columns = [row[1] for row in conn.execute('PRAGMA table_info(flats)')]
+    layout = [f'{c}_id' if c in dimension_columns else c for c in dtype_map]
+    if 'flats' not in tables or (flats_columns == layout and 'flats_history' in tables):
+        return False
+    conn.execute('DROP VIEW IF EXISTS flats_wide')
+    conn.execute('DROP VIEW IF EXISTS flats_price_changes')
+    conn.execute('DROP TABLE IF EXISTS flats')
+    conn.execute('DROP TABLE IF EXISTS flats_history')
+    conn.execute('DROP TABLE IF EXISTS loaded_months')
+    for c in dimension_columns:
+        conn.execute(f'DROP TABLE IF EXISTS dim_{c}')
+    print('Table flats has an old layout, loading it again from the files.')
+    return True
+
+
+#-----------  STAGING TABLE -----------
+def create_staging(conn):
+    #columns of the csv files (categories as text), without the primary key, so a whole file can be checked against the table with one statement
+    conn.execute('DROP TABLE IF EXISTS temp.flats_staging')
+    conn.execute(f"CREATE TEMP TABLE flats_staging AS SELECT {', '.join(dtype_map)} FROM flats_wide WHERE 0")
+
+
+def stage_month(conn, source):
+    '''Copying a cleaned month (dataset directory or csv) into the staging table in typed batches,
+    returns the loaded columns and the number of rows'''
+    conn.execute('DELETE FROM flats_staging')
+    table_cols = [row[1] for row in conn.execute('PRAGMA temp.table_info(flats_staging)')]
+
+    columns = None
+    rows = 0
+    for df in month_batches(source, batch_size):
+        if columns is None:
+            columns = [c for c in dtype_map if c in df.columns and c in table_cols]
+            if 'id' not in columns or 'content_hash' not in columns:
+                raise ValueError(f'No id/content_hash column in {source}, clean it again with flats_cleaning.py')
+            sql_stage = f"INSERT INTO flats_staging ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+        #polars gives None for nulls, rows go to sqlite one batch at a time
+        conn.executemany(sql_stage, df.select(columns).cast({c: dtype_map[c] for c in columns}).iter_rows())
+        rows += len(df)
+    return columns or [], rows
+
+
+def merge_staging(conn, columns):
+    '''New offers inserted and changed offers updated with one statement, returns (added, updated)'''
+    added = conn.execute(
+        'SELECT count(*) FROM flats_staging s WHERE NOT EXISTS (SELECT 1 FROM flats f WHERE f.id = s.id)'
+    ).fetchone()[0]
+
+    #new category values get their codes first
+    for c in dimension_columns:
+        if c in columns:
+            conn.execute(f'INSERT OR IGNORE INTO dim_{c} (name) SELECT DISTINCT {c} FROM flats_staging WHERE {c} IS NOT NULL')
+
+    #text of the categories is replaced with the codes on the way from the staging table
+    targets = [f'{c}_id' if c in dimension_columns else c for c in columns]
+    sources = [f'(SELECT id FROM dim_{c} WHERE name = s.{c})' if c in dimension_columns else f's.{c}' for c in columns]
+    updates_str = ', '.join(f'{c} = excluded.{c}' for c in targets if c != 'id')
+    #WHERE true is needed by sqlite to tell the upsert apart from a join in INSERT ... SELECT,
+    #an offer is only updated from the same or a newer month, so loading an older month again doesn't bring back old states
+    cursor = conn.execute(f"""
+        INSERT INTO flats ({', '.join(targets)})
+        SELECT {', '.join(sources)} FROM flats_staging s WHERE true
+        ON CONFLICT(id) DO UPDATE SET {updates_str}
+        WHERE flats.content_hash IS NOT excluded.content_hash
+        AND (flats.date_scraped IS NULL OR excluded.date_scraped >= flats.date_scraped)
+    """)
+    return added, cursor.rowcount - added
+
+
+#-----------  MONTHLY VERSIONS -----------
+def stage_seen(conn, month):
+    '''Ids of all offers listed in the month: the cleaned ones and the unchanged ones from the active file'''
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen_ids (id INTEGER PRIMARY KEY)')
+    conn.execute('DELETE FROM seen_ids')
+    conn.execute('INSERT OR IGNORE INTO seen_ids SELECT id FROM flats_staging')
+
+    active_path = active_file.format(month=month)
+    if os.path.exists(active_path):
+        active_ids = pl.read_csv(active_path, separator=';', columns=['url']).select(offer_id())
+        conn.executemany('INSERT OR IGNORE INTO seen_ids VALUES (?)', active_ids.iter_rows())
+        print(f'{len(active_ids)} unchanged offers listed in {active_path}')
+
+
+def update_history(conn, month):
+    '''Closing versions which changed or disappeared in the month and opening the new ones'''
+    stage_seen(conn, month[:7])
+    #offers which are not listed anymore
+    conn.execute(
+        'UPDATE flats_history SET valid_to = ? WHERE valid_to IS NULL AND id NOT IN (SELECT id FROM seen_ids)',
+        (month,)
+    )
+    #offers whose content changed
+    conn.execute(
+        """
+        UPDATE flats_history SET valid_to = ?
+        WHERE valid_to IS NULL
+        AND EXISTS (SELECT 1 FROM flats_staging s WHERE s.id = flats_history.id AND s.content_hash IS NOT flats_history.content_hash)
+        """,
+        (month,)
+    )
+    #new versions for new, changed and relisted offers
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO flats_history (id, valid_from, content_hash, price, rent, area, price_per_sq_m)
+        SELECT id, ?, content_hash, price, rent, area, price_per_sq_m
+        FROM flats_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM flats_history h WHERE h.id = s.id AND h.valid_to IS NULL)
+        """,
+        (month,)
+    )
+    #offers relisted unchanged are only in the active file, their content is copied from flats
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO flats_history (id, valid_from, content_hash, price, rent, area, price_per_sq_m)
+        SELECT f.id, ?, f.content_hash, f.price, f.rent, f.area, f.price_per_sq_m
+        FROM seen_ids s
+        JOIN flats f ON f.id = s.id
+        WHERE NOT EXISTS (SELECT 1 FROM flats_history h WHERE h.id = s.id AND h.valid_to IS NULL)
+        """,
+        (month,)
+    )
+    conn.execute('INSERT INTO loaded_months VALUES (?, (SELECT count(*) FROM seen_ids))', (month,))
+
+
+def reopen_month(conn, month):
+    '''Taking the month back out of the history (its versions deleted, versions it closed open again), so it can be applied again'''
+    conn.execute('DELETE FROM flats_history WHERE valid_from = ?', (month,))
+    conn.execute('UPDATE flats_history SET valid_to = NULL WHERE valid_to = ?', (month,))
+    conn.execute('DELETE FROM loaded_months WHERE month = ?', (month,))
+
+
+#-----------  INDEXES AND STATISTICS -----------
+def create_indexes(conn):
+    '''Creating the indexes from the indexes dict and dropping the ones which are no longer there'''
+    existing = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_flats_%'")]
+    for name in existing:
+        if name not in indexes:
+            conn.execute(f'DROP INDEX {name}')
+            print(f'Dropped index {name}')
+
+    #an index whose columns changed is created again
+    for name, columns in indexes.items():
+        indexed = [row[2] for row in conn.execute(f'PRAGMA index_info({name})')]
+        if indexed and indexed != columns:
+            conn.execute(f'DROP INDEX {name}')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON flats ({', '.join(columns)})")
+    conn.commit()
+
+
+def refresh_rollup(conn):
+    '''Building flats_rollup again from the flats table, with the version of the files it was loaded from in rollup_sources'''
+    #derived tables, dropped and created again, so a change of their layout needs no migration
+    conn.execute('DROP TABLE IF EXISTS flats_rollup_sketch')
+    conn.execute('DROP TABLE IF EXISTS flats_rollup')
+    conn.execute('DROP TABLE IF EXISTS rollup_sources')
+    measure_cols = [f'sum_{m}' for m in rollup_measures] + [f'median_{m}' for m in rollup_measures] + ['p01_price_per_sq_m', 'p95_price_per_sq_m']
+    conn.execute(f"""
+        CREATE TABLE flats_rollup (
+            month TEXT NOT NULL,
+            district_id INTEGER,
+            is_primary INTEGER,
+            offers INTEGER,
+            {', '.join(f'{c} REAL' for c in measure_cols)}
+        )
+    """)
+    #the dashboard reads the rows of one month level and market type
+    conn.execute('CREATE UNIQUE INDEX idx_rollup_keys ON flats_rollup (month, is_primary, district_id)')
+    conn.execute('CREATE TABLE rollup_sources (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)')
+
+    def fetch(query):
+        cursor = conn.execute(query)
+        frames = []
+        while rows := cursor.fetchmany(batch_size):
+            frames.append(pl.DataFrame(rows, schema=rollup_columns + rollup_measures, orient='row'))
+        flats = pl.concat(frames) if frames else pl.DataFrame(schema={c: pl.Int64 for c in rollup_columns + rollup_measures})
+        return flats.cast({'month': pl.String, 'district_id': pl.Int64, 'is_primary': pl.Int64, **{m: pl.Float64 for m in rollup_measures}})
+
+    measures = ', '.join(f'h.{m}' for m in rollup_measures)
+    offers = [
+        fetch(f"SELECT 'all', district_id, is_primary, {', '.join(rollup_measures)} FROM flats"),
+        #date_scraped of flats is the month of the last change of an offer, so the months come from the versions valid in each of them,
+        #with the prices of that month and the district and market of the offer
+        fetch(f"""
+            SELECT m.month, f.district_id, f.is_primary, {measures}
+            FROM loaded_months m
+            JOIN flats_history h ON h.valid_from <= m.month AND (h.valid_to IS NULL OR h.valid_to > m.month)
+            JOIN flats f ON f.id = h.id
+        """)
+    ]
+
+    stats = (
+        [pl.len().alias('offers')] +
+        [col(m).sum().alias(f'sum_{m}') for m in rollup_measures] +
+        [col(m).median().alias(f'median_{m}') for m in rollup_measures] +
+        [
+            col('price_per_sq_m').quantile(0.01, 'linear').alias('p01_price_per_sq_m'),
+            col('price_per_sq_m').quantile(0.95, 'linear').alias('p95_price_per_sq_m')
+        ]
+    )
+    #medians can't be added up, so every combination of district and market levels is computed from the offers
+    levels = []
+    for flats in offers:
+        for summed in range(2 ** len(rollup_all)):
+            all_cols = [c for i, c in enumerate(rollup_all) if summed >> i & 1]
+            levels.append(
+                flats
+                .with_columns([pl.lit(rollup_all[c]).cast(pl.Int64).alias(c) for c in all_cols])
+                .group_by(rollup_columns)
+                .agg(stats)
+            )
+    rollup = pl.concat(levels).select(rollup_columns + ['offers'] + measure_cols)
+
+    conn.executemany(f"INSERT INTO flats_rollup VALUES ({', '.join(['?'] * len(rollup.columns))})", rollup.iter_rows())
+    conn.executemany('INSERT INTO rollup_sources VALUES (?, ?, ?)', data_version())
+    conn.commit()
+    print(f'Rollup has {rollup.height} rows.')
+
+
+def analyze(conn):
+    #statistics used by the query planner to choose between the indexes, refreshed after every load
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+#-----------  LOADING MONTHS -----------
+def load_month(conn, month, source):
+    #every month goes into flats again (the upsert skips unchanged offers), so a month cleaned again after a resumed scrape is picked up
+    month = f'{month}-01'
+    last_month = conn.execute('SELECT max(month) FROM loaded_months').fetchone()[0]
+
+    print(f'Loading {source}')
+    try:
+        columns, rows = stage_month(conn, source)
+        added, updated = merge_staging(conn, columns)
+
+        #history is applied in order, the latest month is taken back and applied again,
+        #an older month can't be put between versions already closed
+        if last_month is not None and month < last_month:
+            print(f'History is kept as it is, months till {last_month[:7]} are already applied')
+        else:
+            if month == last_month:
+                reopen_month(conn, month)
+            update_history(conn, month)
+        #one transaction per month, an error leaves the db as it was before the month
+        conn.commit()
+    except (pl.exceptions.PolarsError, ValueError, sqlite3.Error) as e:
+        conn.rollback()
+        print(f'Error loading {source}: {e}')
+        return
+
+    if added or updated:
+        print(f'Added {added} unique offers, updated {updated} changed offers ({rows} rows in the month).')
     else:
         print('No new offers added')
 
-conn.close()
-print('DB creation/upload finished.')
\ No newline at end of file
+
+def main():
+    #cleaned months, from the parquet dataset or from the csv files
+    sources = month_sources()
+
+    conn = connect()
+    rebuilt = migrate(conn)
+
+    #if table doesn't exist we create one
+    create_table_if_not_exists(conn)
+    conn.execute(f'PRAGMA user_version = {schema_version}')
+    print(f"There are {conn.execute('SELECT count(*) FROM flats').fetchone()[0]} offers in db.")
+
+    create_staging(conn)
+    for month, source in sources.items():
+        load_month(conn, month, source)
+
+    #created after the load, so a rebuilt table is indexed once instead of row by row
+    create_indexes(conn)
+    refresh_rollup(conn)
+    analyze(conn)
+
+    #pages of a dropped table are given back to the file system
+    if rebuilt:
+        conn.execute('VACUUM')
+    conn.close()
+    print('DB creation/upload finished.')
+
+
+if __name__ == '__main__':
+    main()